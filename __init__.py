@@ -1,8 +1,17 @@
-from aqt import browser, gui_hooks, qt
-from . import voicevox_gen
+try:
+    from aqt import mw
+except ImportError:
+    mw = None # Imported without Anki installed, e.g. by cli.py on a server
 
-def on_browser_will_show_context_menu(browser: browser.Browser, menu: qt.QMenu):
-    menu.addSeparator()
-    menu.addAction("Generate VOICEVOX Audio", lambda: voicevox_gen.onVoicevoxOptionSelected(browser))
-    
-gui_hooks.browser_will_show_context_menu.append(on_browser_will_show_context_menu)
\ No newline at end of file
+if mw is not None:
+    from aqt import browser, gui_hooks, qt
+    from . import voicevox_gen
+    from . import auto_gen
+    from . import pronunciation
+
+    def on_browser_will_show_context_menu(browser: browser.Browser, menu: qt.QMenu):
+        menu.addSeparator()
+        menu.addAction("Generate VOICEVOX Audio", lambda: voicevox_gen.onVoicevoxOptionSelected(browser))
+        menu.addAction("Fix VOICEVOX Pronunciation", lambda: pronunciation.onFixPronunciationSelected(browser))
+        
+    gui_hooks.browser_will_show_context_menu.append(on_browser_will_show_context_menu)
\ No newline at end of file
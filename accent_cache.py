@@ -0,0 +1,97 @@
+# Pronunciation fixes that survive regenerating audio.
+# AccentPhraseStore keeps the user's corrected accent phrases per text, GenerateAudioQuery checks it before asking the engine to analyze the text.
+# SyncUserDict pushes the `user_dict` words from the config into the engine's user dictionary so fixes for single words apply everywhere
+import json
+import os
+import threading
+import unicodedata
+from os.path import join, dirname, exists
+from . import generation
+
+ACCENT_PHRASES_FILENAME = "accent_phrases.json"
+
+class AccentPhraseStore:
+    def __init__(self, path):
+        self.path = path
+        # Read from worker threads when generating with concurrency > 1
+        self.lock = threading.Lock()
+        self.entries = None
+
+    def load(self):
+        with self.lock:
+            if self.entries is not None:
+                return
+            self.entries = {}
+            if exists(self.path):
+                try:
+                    with open(self.path, "r", encoding="utf8") as f:
+                        self.entries = json.load(f)
+                except Exception as e:
+                    print(f"VOICEVOX: Unable to read {self.path}, pronunciation fixes won't be used: {e}")
+
+    def save(self):
+        with self.lock:
+            os.makedirs(dirname(self.path), exist_ok=True)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf8") as f:
+                json.dump(self.entries, f, ensure_ascii=False, indent=1)
+            os.replace(temp_path, self.path)
+
+    def get(self, text):
+        # Returns {'kana': ..., 'accent_phrases': [...]} or None
+        self.load()
+        return self.entries.get(text)
+
+    def set(self, text, accent_phrases, kana):
+        self.load()
+        self.entries[text] = {'kana': kana, 'accent_phrases': accent_phrases}
+        self.save()
+
+    def remove(self, text):
+        self.load()
+        if self.entries.pop(text, None) is not None:
+            self.save()
+
+default_store = None
+
+def getDefaultStore():
+    # Lives in user_files so updating the addon doesn't throw away the user's fixes
+    global default_store
+    if default_store is None:
+        default_store = AccentPhraseStore(join(dirname(__file__), "user_files", ACCENT_PHRASES_FILENAME))
+    return default_store
+
+def normalizeSurface(surface):
+    # The engine stores surfaces as full width (ABC -> ＡＢＣ), so compare the NFKC forms
+    return unicodedata.normalize("NFKC", surface)
+
+synced_user_dicts = {}
+
+def SyncUserDict(words, engine_url=generation.DEFAULT_ENGINE_URL):
+    # words is the `user_dict` list from the config: [{"surface": "...", "pronunciation": "カタカナ", "accent_type": 1, "word_type": "PROPER_NOUN", "priority": 5}, ...]
+    # Only words that are missing or different in the engine are sent. Returns how many words were added/updated
+    if not words:
+        return 0
+    words_key = json.dumps(words, sort_keys=True, ensure_ascii=False)
+    if synced_user_dicts.get(engine_url) == words_key:
+        return 0 # Already synced these exact words to this engine during this session
+
+    existing = {}
+    for word_uuid, word in generation.GetUserDict(engine_url).items():
+        existing[normalizeSurface(word['surface'])] = (word_uuid, word)
+
+    changed = 0
+    for word in words:
+        match = existing.get(normalizeSurface(word['surface']))
+        if match is None:
+            generation.AddUserDictWord(word, engine_url)
+            changed += 1
+            continue
+        word_uuid, engine_word = match
+        priority_changed = word.get('priority') is not None and engine_word.get('priority') != word['priority']
+        if engine_word.get('pronunciation') != word['pronunciation'] or engine_word.get('accent_type') != word.get('accent_type', 0) or priority_changed:
+            generation.UpdateUserDictWord(word_uuid, word, engine_url)
+            changed += 1
+
+    synced_user_dicts[engine_url] = words_key
+    return changed
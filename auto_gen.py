@@ -0,0 +1,297 @@
+from aqt import mw, gui_hooks, qt
+from aqt.utils import tooltip, showWarning
+from aqt.operations.note import update_notes
+from os.path import join, dirname, exists
+import os
+import json
+import traceback
+import requests
+from . import generation
+from . import accent_cache
+
+# Notes added through the Add window are queued here and generated in the background once the user stops adding cards for a bit.
+# The queue is saved to user_files so notes added right before closing Anki still get audio next time.
+
+QUEUE_FILENAME = "auto_queue.json"
+
+def isConnectionError(e):
+    # generation wraps engine errors in its own exceptions, so look through the whole chain
+    while e is not None:
+        if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return True
+        e = e.__cause__ or e.__context__
+    return False
+
+def getConfigKey(config):
+    return json.dumps(config, sort_keys=True, ensure_ascii=False)
+
+class AutoGenerateQueue:
+    def __init__(self):
+        self.pending = []
+        self.running = False
+        self.timer = None
+        # Set to the config a batch failed with for a reason retrying won't fix (like an unknown speaker), nothing is generated until the config changes
+        self.failed_config_key = None
+
+    def getSettings(self):
+        config = mw.addonManager.getConfig(__name__) or {}
+        settings = config.get('auto_generate') or {}
+        return config, settings
+
+    def getQueuePath(self):
+        user_files = join(dirname(__file__), "user_files")
+        os.makedirs(user_files, exist_ok=True)
+        # Note ids only make sense for one collection, so every profile gets its own queue
+        return join(user_files, f"{mw.pm.name}_{QUEUE_FILENAME}")
+
+    def load(self):
+        self.pending = []
+        queue_path = self.getQueuePath()
+        if exists(queue_path):
+            try:
+                with open(queue_path, "r", encoding="utf8") as f:
+                    self.pending = json.load(f).get('pending', [])
+            except Exception:
+                print("VOICEVOX: Unable to read the auto generation queue, starting with an empty one")
+                traceback.print_exc()
+
+    def save(self):
+        queue_path = self.getQueuePath()
+        temp_path = queue_path + ".tmp"
+        with open(temp_path, "w", encoding="utf8") as f:
+            json.dump({'pending': self.pending}, f)
+        os.replace(temp_path, queue_path)
+
+    def noteMatches(self, note, settings):
+        source_field = settings.get('source_field') or ''
+        destination_field = settings.get('destination_field') or ''
+        if source_field not in note or destination_field not in note:
+            return False
+        if not note[source_field].strip():
+            return False
+        # Don't overwrite audio the user added themselves
+        if note[destination_field].strip():
+            return False
+
+        note_types = settings.get('note_types') or []
+        if note_types and note.note_type()['name'] not in note_types:
+            return False
+
+        decks = settings.get('decks') or []
+        if decks:
+            deck_name = generation.getNoteDeckName(note)
+            if deck_name is None or not generation.matchesAnyPattern(deck_name, decks):
+                return False
+        return True
+
+    def onNoteAdded(self, note):
+        config, settings = self.getSettings()
+        if not settings.get('enabled'):
+            return
+        if not self.noteMatches(note, settings):
+            return
+        if note.id not in self.pending:
+            self.pending.append(note.id)
+            self.save()
+        self.schedule(settings)
+
+    def schedule(self, settings, delay_seconds=None):
+        if delay_seconds is None:
+            delay_seconds = settings.get('debounce_seconds', 5)
+        if self.timer is None:
+            self.timer = qt.QTimer(mw)
+            self.timer.setSingleShot(True)
+            self.timer.timeout.connect(self.flush)
+        # Restarting the timer is what debounces it, every new note pushes the generation back
+        self.timer.start(int(delay_seconds * 1000))
+
+    def flush(self):
+        if self.running or not self.pending or mw.col is None:
+            return
+        config, settings = self.getSettings()
+        if self.failed_config_key is not None:
+            if self.failed_config_key == getConfigKey(config):
+                return
+            self.failed_config_key = None
+
+        # Don't fight the user for the collection while they're in the middle of something
+        if mw.app.activeModalWidget() is not None:
+            self.schedule(settings)
+            return
+
+        batch_size = settings.get('batch_size', 16)
+        batch = []
+        for note_id in self.pending[:batch_size]:
+            try:
+                note = mw.col.get_note(note_id)
+            except Exception:
+                note = None # note got deleted before we got to it
+            if note is None or not self.noteMatches(note, settings):
+                self.pending.remove(note_id)
+                continue
+            batch.append(note)
+        self.save()
+        if not batch:
+            self.flush()
+            return
+
+        default_speaker_name = settings.get('speaker') or config.get('last_speaker_name')
+        default_style_name = settings.get('style') or config.get('last_style_name')
+        speaker_mapping = config.get('speaker_mapping') or []
+        # Everything that needs the collection is done here on the main thread, the background task only gets plain text
+        speaker_groups = []
+        for (speaker_name, style_name), notes in generation.GroupNotesBySpeaker(batch, speaker_mapping, default_speaker_name, default_style_name).items():
+            texts = [generation.getNoteText(note, settings['source_field']) for note in notes]
+            speaker_groups.append((speaker_name, style_name, [note.id for note in notes], texts))
+
+        def generate():
+            speaker_json = generation.getSpeakersOrNone(generation.getEngineUrl(config))
+            if speaker_json is None:
+                raise requests.exceptions.ConnectionError("VOICEVOX service is not running")
+            speakers = generation.getSpeakerList(speaker_json)
+            # A bad `user_dict` entry shouldn't stop the audio from being generated, same as in the browser dialog
+            user_dict_error = None
+            try:
+                accent_cache.SyncUserDict(config.get('user_dict') or [], generation.getEngineUrl(config))
+            except Exception as e:
+                user_dict_error = e
+            results = []
+            # (note_id, exception) for notes VOICEVOX couldn't generate audio for
+            failed_notes = []
+            for speaker_name, style_name, note_ids, texts in speaker_groups:
+                if speaker_name is None:
+                    raise Exception("No speaker picked. Set `speaker` and `style` under `auto_generate` in the addon config, or generate audio from the browser once")
+                style_info = generation.getSpeakerStyle(speakers, speaker_name, style_name)
+                if style_info is None:
+                    raise Exception(f"Speaker '{speaker_name}' with style '{style_name}' not found")
+                style_name, speaker_index = style_info
+                try:
+                    audio_results = generation.SynthesizeChunk(texts, speaker_index, config, accent_store=accent_cache.getDefaultStore())
+                    results.append((speaker_name, style_name, note_ids, texts, audio_results))
+                    continue
+                except Exception as e:
+                    if isConnectionError(e):
+                        raise
+                # Most likely the engine can't read one of the texts, go note by note so only that note is left out
+                for note_id, text in zip(note_ids, texts):
+                    try:
+                        audio_results = generation.SynthesizeChunk([text], speaker_index, config, accent_store=accent_cache.getDefaultStore())
+                    except Exception as e:
+                        if isConnectionError(e):
+                            raise
+                        failed_notes.append((note_id, e))
+                        continue
+                    results.append((speaker_name, style_name, [note_id], [text], audio_results))
+            return results, failed_notes, user_dict_error
+
+        def on_done(future):
+            self.running = False
+            try:
+                results, failed_notes, user_dict_error = future.result()
+            except Exception as e:
+                # Leave everything in the queue either way
+                if isConnectionError(e):
+                    # The engine just isn't running right now, try again later
+                    print(f"VOICEVOX auto generation failed: {e}")
+                    self.schedule(settings, settings.get('retry_seconds', 60))
+                    return
+                # Errors from a single note's text are dealt with in generate(), what's left comes from the config (like an unknown speaker).
+                # Retrying won't help with that, so tell the user and wait for them to change the config
+                self.failed_config_key = getConfigKey(config)
+                showWarning(f"VOICEVOX couldn't generate audio for new notes, fix the addon config and it'll try again.\n\n{e}")
+                return
+
+            if user_dict_error is not None:
+                print(f"VOICEVOX: Unable to update the user dictionary, generating without it: {user_dict_error}")
+                tooltip("VOICEVOX: Unable to update the user dictionary from `user_dict` in the addon config, generating without it")
+
+            if failed_notes:
+                # Retrying the same text would fail again and hold up the rest of the queue, so these are dropped
+                for note_id, e in failed_notes:
+                    print(f"VOICEVOX auto generation skipped note {note_id}: {e}")
+                    if note_id in self.pending:
+                        self.pending.remove(note_id)
+                self.save()
+                tooltip(f"VOICEVOX: Couldn't generate audio for {len(failed_notes)} new notes, try generating them from the browser to see why")
+
+            if mw.col is None:
+                return # profile got closed while generating, the queue is still saved so it'll be picked up next time
+
+            filename_template = generation.FilenameTemplate(config.get("filename_template") or generation.DEFAULT_FILENAME_TEMPLATE)
+            media_writer = generation.MediaWriter(mw.col)
+            notes = []
+            try:
+                writes = []
+                for speaker_name, style_name, note_ids, texts, audio_results in results:
+                    # The user had a while to delete the note or fill in the destination field themselves, check again before touching it
+                    clips = []
+                    saved_note_ids = []
+                    for note_id, text, (audio_data, audio_extension, wav_hash) in zip(note_ids, texts, audio_results):
+                        try:
+                            note = mw.col.get_note(note_id)
+                        except Exception:
+                            note = None # deleted
+                        if note is None or not self.noteMatches(note, settings):
+                            if note_id in self.pending:
+                                self.pending.remove(note_id)
+                            continue
+                        clips.append((filename_template.getFilename(note, audio_extension, speaker_name, style_name, text, wav_hash), audio_data))
+                        saved_note_ids.append(note_id)
+                    writes.append((saved_note_ids, media_writer.writeBatch(clips)))
+                for note_ids, write_future in writes:
+                    notes.extend(generation.getNotesWithAudio(mw.col, note_ids, write_future.result(), settings['destination_field'], False))
+            finally:
+                media_writer.close()
+            self.save()
+            if not notes:
+                self.finishBatch(settings)
+                return
+
+            def on_saved(changes):
+                for note in notes:
+                    if note.id in self.pending:
+                        self.pending.remove(note.id)
+                self.save()
+                tooltip(f"VOICEVOX: Generated audio for {len(notes)} new notes")
+                self.finishBatch(settings)
+
+            def on_save_failed(e):
+                showWarning(f"VOICEVOX couldn't save the audio for new notes, it'll try again.\n\n{e}")
+                self.finishBatch(settings)
+
+            # Saved through an op instead of col.update_notes so an editor or browser that has one of these notes open reloads it
+            # instead of saving its old copy over the audio later. Still running until it's done so the same notes aren't picked up twice
+            self.running = True
+            update_notes(parent=mw, notes=notes).success(on_saved).failure(on_save_failed).run_in_background()
+
+        self.running = True
+        mw.taskman.run_in_background(generate, on_done)
+
+    def finishBatch(self, settings):
+        self.running = False
+        if self.pending:
+            self.schedule(settings, 0)
+
+    def onProfileOpened(self):
+        self.load()
+        if self.pending:
+            config, settings = self.getSettings()
+            if settings.get('enabled'):
+                self.schedule(settings)
+
+    def onConfigUpdated(self, config):
+        self.failed_config_key = None
+        settings = config.get('auto_generate') or {}
+        if self.pending and settings.get('enabled'):
+            self.schedule(settings)
+
+    def onProfileClosing(self):
+        if self.timer is not None:
+            self.timer.stop()
+
+autoGenerateQueue = AutoGenerateQueue()
+
+gui_hooks.add_cards_did_add_note.append(autoGenerateQueue.onNoteAdded)
+gui_hooks.profile_did_open.append(autoGenerateQueue.onProfileOpened)
+gui_hooks.profile_will_close.append(autoGenerateQueue.onProfileClosing)
+mw.addonManager.setConfigUpdatedAction(__name__, autoGenerateQueue.onConfigUpdated)
@@ -0,0 +1,163 @@
+# Measures how fast the generation path is, using bench/stub_engine.py instead of VOICEVOX so the engine itself doesn't drown out the numbers.
+#   python bench/run_bench.py --notes 50,200 --chunk-sizes 1,4,16 --formats wav,mp3
+# Runs generation.GenerateAudioForChunks over a throwaway collection full of synthetic notes for every combination of the options
+# and reports notes/sec, p50/p99 per stage (from JobStats) and peak RSS. Every combination runs in its own process so peak RSS isn't shared between them.
+# The stub engine gets a process of its own as well so its work isn't counted as the addon's.
+# Needs the `anki` and `requests` packages, and ffmpeg for the mp3/opus formats (otherwise those runs end up as wav, see the format column)
+import argparse
+import importlib
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+from os.path import abspath, basename, dirname, join
+
+ADDON_DIR = dirname(dirname(abspath(__file__)))
+
+SAMPLE_CHARACTERS = "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん日本語勉強先生学校電車時間今"
+
+def makeNoteTexts(count, min_length, max_length, seed):
+    rng = random.Random(seed)
+    return ["".join(rng.choice(SAMPLE_CHARACTERS) for _ in range(rng.randint(min_length, max_length))) + "。" for _ in range(count)]
+
+def getPeakRssMb():
+    try:
+        import resource
+    except ImportError:
+        return None # Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak / (1024 * 1024) if sys.platform.startswith("darwin") else peak / 1024
+
+def importAddon():
+    # The addon folder is a package (relative imports), so import it by its folder name like cli.py does
+    sys.path.insert(0, dirname(ADDON_DIR))
+    from anki.collection import Collection # has to come before anything imports anki.hooks
+    package = basename(ADDON_DIR)
+    importlib.import_module(package)
+    return Collection, importlib.import_module(package + ".generation"), importlib.import_module(package + ".ffmpeg")
+
+def startStubEngineProcess(options):
+    # The stub runs in its own process so its json/zip work doesn't compete for the GIL with the generation loop
+    # and its buffers don't end up in the measured peak RSS. Returns (process, engine_url)
+    command = [sys.executable, join(dirname(abspath(__file__)), "stub_engine.py"), "--port", "0",
+               "--query-latency", str(options['query_latency']), "--mora-latency", str(options['mora_latency'])]
+    if options['wav_seconds'] is not None:
+        command += ["--wav-seconds", str(options['wav_seconds'])]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if "http://" not in line:
+        process.kill()
+        raise Exception("The stub engine didn't start")
+    return process, line.strip().split(" ")[-1]
+
+def runOne(options):
+    Collection, generation, ffmpeg = importAddon()
+
+    stub_process, engine_url = startStubEngineProcess(options)
+    try:
+        if options['format'] != "wav":
+            # Only use an ffmpeg that's already there, a benchmark shouldn't go downloading things
+            ffmpeg.ffmpegInstaller.can_convert = os.path.exists(ffmpeg.ffmpegInstaller.full_ffmpeg_path)
+            if not ffmpeg.ffmpegInstaller.can_convert:
+                import shutil
+                system_ffmpeg_path = shutil.which("ffmpeg")
+                if system_ffmpeg_path:
+                    ffmpeg.ffmpegInstaller.full_ffmpeg_path = system_ffmpeg_path
+                    ffmpeg.ffmpegInstaller.can_convert = True
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            col = Collection(join(temp_dir, "collection.anki2"))
+            try:
+                model = col.models.by_name("Basic")
+                deck_id = col.decks.id("Bench")
+                for text in makeNoteTexts(options['notes'], options['min_length'], options['max_length'], options['seed']):
+                    note = col.new_note(model)
+                    note['Front'] = text
+                    col.add_note(note, deck_id)
+                notes = [col.get_note(note_id) for note_id in col.find_notes("")]
+
+                config = {'engine_url': engine_url, 'audio_format': options['format']}
+                speakers = generation.getSpeakerList(generation.getSpeakersOrNone(engine_url))
+                planned_chunks = generation.PlanSpeakerChunks(notes, speakers, [], speakers[0][0], speakers[0][1][0][0], options['chunk_size'])
+                stats = generation.JobStats()
+                generation.GenerateAudioForChunks(col, planned_chunks, "Front", "Back", config, concurrency=options['concurrency'], stats=stats)
+                saved_format = col.get_note(notes[0].id)['Back'].rsplit(".", 1)[-1].rstrip("]")
+            finally:
+                col.close()
+    finally:
+        stub_process.terminate()
+        stub_process.wait()
+
+    return {
+        **options,
+        **stats.toDict(),
+        'saved_format': saved_format,
+        'peak_rss_mb': getPeakRssMb(),
+    }
+
+def formatMs(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.1f}"
+
+def printResults(results):
+    stages = ["text_normalization", "audio_query", "synthesis", "zip_unpack", "encode", "filename", "media_write", "note_update"]
+    header = ["notes", "chunk", "conc", "format", "notes/s", "rss MB"] + [f"{stage} p50/p99 ms" for stage in stages]
+    print("stage timings are per note, except synthesis and note_update which are per chunk")
+    rows = []
+    for result in results:
+        row = [str(result['notes']), str(result['chunk_size']), str(result['concurrency']), result['format'] if result['format'] == result['saved_format'] else f"{result['format']}->{result['saved_format']}", f"{result['notes_per_second']:.1f}", "-" if result['peak_rss_mb'] is None else f"{result['peak_rss_mb']:.0f}"]
+        for stage in stages:
+            stats = result['stages'].get(stage)
+            row.append("-" if stats is None else f"{formatMs(stats['p50'])}/{formatMs(stats['p99'])}")
+        rows.append(row)
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    for row in [header] + rows:
+        print("  ".join(value.rjust(width) for value, width in zip(row, widths)))
+
+def parseList(value, convert):
+    return [convert(x) for x in value.split(",") if x.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark audio generation against a stub VOICEVOX engine")
+    parser.add_argument("--notes", default="50,200", help="Comma separated note counts")
+    parser.add_argument("--chunk-sizes", default="1,4,16", help="Comma separated chunk sizes")
+    parser.add_argument("--formats", default="wav,mp3", help="Comma separated formats (wav, mp3, opus)")
+    parser.add_argument("--concurrency", default="1", help="Comma separated concurrency values")
+    parser.add_argument("--query-latency", type=float, default=0.002, help="Seconds every /audio_query takes in the stub engine")
+    parser.add_argument("--mora-latency", type=float, default=0.0005, help="Seconds every synthesized mora takes in the stub engine")
+    parser.add_argument("--wav-seconds", type=float, default=None, help="Fixed length of every wav. Defaults to roughly what VOICEVOX would generate")
+    parser.add_argument("--min-length", type=int, default=8, help="Shortest synthetic sentence in characters")
+    parser.add_argument("--max-length", type=int, default=40, help="Longest synthetic sentence in characters")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Also write the raw results to this JSON file")
+    parser.add_argument("--run", default=None, help=argparse.SUPPRESS) # a single configuration as JSON, used internally
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(runOne(json.loads(args.run))))
+        return 0
+
+    results = []
+    for notes, chunk_size, audio_format, concurrency in itertools.product(parseList(args.notes, int), parseList(args.chunk_sizes, int), parseList(args.formats, str), parseList(args.concurrency, int)):
+        options = {
+            'notes': notes, 'chunk_size': chunk_size, 'format': audio_format, 'concurrency': concurrency,
+            'query_latency': args.query_latency, 'mora_latency': args.mora_latency, 'wav_seconds': args.wav_seconds,
+            'min_length': args.min_length, 'max_length': args.max_length, 'seed': args.seed,
+        }
+        output = subprocess.run([sys.executable, abspath(__file__), "--run", json.dumps(options)], capture_output=True, text=True)
+        if output.returncode != 0:
+            print(f"Run failed for {options}:\n{output.stderr}", file=sys.stderr)
+            return 1
+        results.append(json.loads(output.stdout))
+
+    printResults(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
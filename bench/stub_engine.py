@@ -0,0 +1,163 @@
+# A stand-in for the VOICEVOX engine that answers the endpoints this addon uses with silent audio.
+# Useful for trying cli.py on a machine without VOICEVOX, and bench/run_bench.py uses it to get repeatable numbers:
+#   python bench/stub_engine.py --port 50021 --mora-latency 0.002
+# It only implements enough of the API for this addon, the audio is always silence
+import argparse
+import io
+import json
+import time
+import uuid
+import wave
+import zipfile
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+STUB_SPEAKERS = [
+    {"name": "Stub Speaker", "speaker_uuid": "00000000-0000-0000-0000-000000000000", "styles": [{"name": "ノーマル", "id": 0}, {"name": "Whisper", "id": 1}]},
+    {"name": "Other Stub Speaker", "speaker_uuid": "00000000-0000-0000-0000-000000000001", "styles": [{"name": "ノーマル", "id": 2}]},
+]
+
+SAMPLE_RATE = 24000
+
+def makeSilentWav(seconds):
+    wav_bytes = io.BytesIO()
+    with wave.open(wav_bytes, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes(b"\0\0" * int(SAMPLE_RATE * seconds))
+    return wav_bytes.getvalue()
+
+def makeAccentPhrases(text):
+    # One mora per character is close enough for a stub
+    moras = [{"text": c, "consonant": None, "consonant_length": None, "vowel": "a", "vowel_length": 0.1, "pitch": 5.5} for c in text if c not in "'/、_?"]
+    return [{"moras": moras, "accent": 1, "pause_mora": None, "is_interrogative": False}] if moras else []
+
+def makeAudioQuery(text):
+    return {
+        "accent_phrases": makeAccentPhrases(text),
+        "speedScale": 1.0,
+        "pitchScale": 0.0,
+        "intonationScale": 1.0,
+        "volumeScale": 1.0,
+        "prePhonemeLength": 0.1,
+        "postPhonemeLength": 0.1,
+        "outputSamplingRate": SAMPLE_RATE,
+        "outputStereo": False,
+        "kana": text,
+    }
+
+def getMoraCount(audio_query):
+    return sum(len(phrase["moras"]) for phrase in audio_query.get("accent_phrases", []))
+
+def getQueryLength(audio_query):
+    # Roughly how long the real engine's audio would be, used to size the silent wav
+    return (getMoraCount(audio_query) * 0.1) / audio_query.get("speedScale", 1.0) + audio_query.get("prePhonemeLength", 0.1) + audio_query.get("postPhonemeLength", 0.1)
+
+class StubEngineHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def sendBody(self, body, content_type="application/json"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def sendJson(self, obj):
+        self.sendBody(json.dumps(obj, ensure_ascii=False).encode("utf8"))
+
+    def readBody(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/version":
+            self.sendJson("0.0.0-stub")
+        elif path == "/speakers":
+            self.sendJson(STUB_SPEAKERS)
+        elif path == "/user_dict":
+            self.sendJson(self.server.user_dict)
+        else:
+            self.send_error(404)
+
+    def makeWav(self, audio_query):
+        # Pretend synthesizing takes time proportional to the number of moras, like the real engine
+        time.sleep(self.server.mora_latency * getMoraCount(audio_query))
+        if self.server.wav_seconds is not None:
+            return makeSilentWav(self.server.wav_seconds)
+        return makeSilentWav(getQueryLength(audio_query))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        body = self.readBody()
+        if url.path == "/audio_query":
+            time.sleep(self.server.query_latency)
+            self.sendJson(makeAudioQuery(query.get("text", [""])[0]))
+        elif url.path == "/accent_phrases":
+            self.sendJson(makeAccentPhrases(query.get("text", [""])[0]))
+        elif url.path == "/mora_data":
+            self.sendJson(json.loads(body))
+        elif url.path == "/user_dict_word":
+            word_uuid = str(uuid.uuid4())
+            self.server.user_dict[word_uuid] = self.makeUserDictWord(query)
+            self.sendJson(word_uuid)
+        elif url.path == "/synthesis":
+            self.sendBody(self.makeWav(json.loads(body)), "audio/wav")
+        elif url.path == "/multi_synthesis":
+            zip_bytes = io.BytesIO()
+            with zipfile.ZipFile(zip_bytes, "w", zipfile.ZIP_STORED) as wavs_zip:
+                for i, audio_query in enumerate(json.loads(body)):
+                    wavs_zip.writestr(f"{i + 1:03}.wav", self.makeWav(audio_query))
+            self.sendBody(zip_bytes.getvalue(), "application/zip")
+        else:
+            self.send_error(404)
+
+    def do_PUT(self):
+        url = urlparse(self.path)
+        self.readBody()
+        word_uuid = url.path[len("/user_dict_word/"):]
+        if url.path.startswith("/user_dict_word/") and word_uuid in self.server.user_dict:
+            self.server.user_dict[word_uuid] = self.makeUserDictWord(parse_qs(url.query))
+            self.send_response(204)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            self.send_error(404)
+
+    def makeUserDictWord(self, query):
+        return {
+            "surface": query["surface"][0],
+            "pronunciation": query["pronunciation"][0],
+            "accent_type": int(query["accent_type"][0]),
+            "priority": int(query.get("priority", ["5"])[0]),
+        }
+
+    def log_message(self, format, *args):
+        pass
+
+def startStubEngine(host="127.0.0.1", port=0, query_latency=0.0, mora_latency=0.0, wav_seconds=None):
+    # port=0 picks a free port, the real one is in server.server_address.
+    # query_latency is seconds per /audio_query, mora_latency is seconds per synthesized mora and
+    # wav_seconds fixes the length (and so the size) of every wav instead of deriving it from the text
+    server = ThreadingHTTPServer((host, port), StubEngineHandler)
+    server.query_latency = query_latency
+    server.mora_latency = mora_latency
+    server.wav_seconds = wav_seconds
+    server.user_dict = {}
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in VOICEVOX engine that returns silent audio")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=50021, help="0 picks a free port")
+    parser.add_argument("--query-latency", type=float, default=0.0, help="Seconds every /audio_query takes")
+    parser.add_argument("--mora-latency", type=float, default=0.0, help="Seconds every synthesized mora takes")
+    parser.add_argument("--wav-seconds", type=float, default=None, help="Length of every generated wav (24kHz 16bit mono, so 48000 bytes per second). Defaults to roughly what VOICEVOX would generate for the text")
+    args = parser.parse_args()
+    server = startStubEngine(args.host, args.port, args.query_latency, args.mora_latency, args.wav_seconds)
+    # run_bench.py reads the address from this line, so it has to get out even when stdout is a pipe
+    print(f"Stub VOICEVOX engine listening on http://{server.server_address[0]}:{server.server_address[1]}", flush=True)
+    server.serve_forever()
@@ -1,3 +1,3 @@
 del /f "VOICEVOX Audio Generator.ankiaddon"
-powershell -Command "& {Compress-Archive -LiteralPath __init__.py, ffmpeg.py, voicevox_gen.py, config.json, config.md, manifest.json, README.md -DestinationPath VOICEVOX-Audio-Generator.zip -Force}"
+powershell -Command "& {Compress-Archive -LiteralPath __init__.py, ffmpeg.py, voicevox_gen.py, auto_gen.py, generation.py, job_stats.py, media_writer.py, accent_cache.py, pronunciation.py, cli.py, config.json, config.md, manifest.json, README.md -DestinationPath VOICEVOX-Audio-Generator.zip -Force}"
 rename VOICEVOX-Audio-Generator.zip "VOICEVOX Audio Generator.ankiaddon"
\ No newline at end of file
@@ -0,0 +1,133 @@
+# Generates audio for a whole collection without opening Anki, for example on a server:
+#   python cli.py path/to/collection.anki2 --deck "Japanese" --source Sentence --destination Audio --speaker 四国めたん --style ノーマル
+# Needs the `anki` and `requests` packages (pip install anki requests) and a running VOICEVOX engine.
+# Make sure Anki isn't open on the same collection while this runs
+if __name__ == "__main__" and not __package__:
+    # Running as a plain script, so import the addon folder as a package to make the relative imports below work
+    import importlib
+    import sys
+    from os.path import abspath, basename, dirname
+    sys.path.insert(0, dirname(dirname(abspath(__file__))))
+    __package__ = basename(dirname(abspath(__file__)))
+    importlib.import_module(__package__)
+
+import argparse
+import json
+import sys
+from os.path import dirname, join
+from anki.collection import Collection # NOTE: has to be imported before anything imports anki.hooks (ffmpeg does) or anki runs into a circular import
+from . import ffmpeg
+from . import generation
+from . import accent_cache
+
+def buildSearch(search, decks):
+    parts = []
+    if search:
+        parts.append(f"({search})")
+    if decks:
+        deck_searches = ['deck:"' + deck.replace('"', '\\"') + '"' for deck in decks]
+        parts.append("(" + " OR ".join(deck_searches) + ")")
+    return " ".join(parts)
+
+def loadConfig(config_path):
+    if not config_path:
+        return {}
+    with open(config_path, "r", encoding="utf8") as f:
+        config = json.load(f)
+    # Accept the addon's meta.json as is, the actual config is stored under "config" there
+    if 'config' in config and isinstance(config['config'], dict):
+        config = config['config']
+    return config
+
+def positiveInt(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"must be a whole number, got {value}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be 1 or more, got {value}")
+    return number
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate VOICEVOX audio for the notes in an Anki collection without opening Anki")
+    parser.add_argument("collection", help="Path to the collection file (collection.anki2)")
+    parser.add_argument("--search", default="", help="Anki search to pick the notes, for example 'tag:mining -is:suspended'")
+    parser.add_argument("--deck", action="append", default=[], help="Only notes in this deck (and its subdecks). Can be given more than once")
+    parser.add_argument("--source", required=True, help="Field to read the text from")
+    parser.add_argument("--destination", required=True, help="Field to write the audio to")
+    parser.add_argument("--speaker", required=True, help="Speaker name as shown in the generate dialog")
+    parser.add_argument("--style", default=None, help="Style name. Defaults to the speaker's first style")
+    parser.add_argument("--format", default="mp3", choices=["mp3", "opus", "wav"], help="Audio format to save")
+    parser.add_argument("--concurrency", type=positiveInt, default=1, help="How many chunks to synthesize at the same time")
+    parser.add_argument("--chunk-size", type=positiveInt, default=4, help="How many notes to send to VOICEVOX in a single request")
+    parser.add_argument("--filename-template", default=None, help=f"Defaults to {generation.DEFAULT_FILENAME_TEMPLATE}")
+    parser.add_argument("--append", action="store_true", help="Append the audio to the destination field instead of overwriting it")
+    parser.add_argument("--skip-existing", action="store_true", help="Skip notes that already have something in the destination field")
+    parser.add_argument("--config", default=None, help="JSON file with addon settings (slider values, speaker_mapping, ...). The addon's meta.json works")
+    parser.add_argument("--engine-url", default=None, help=f"Defaults to {generation.DEFAULT_ENGINE_URL}")
+    parser.add_argument("--report-dir", default=join(dirname(__file__), "user_files", "reports"), help="Where to write the JSON/CSV timing report for the job")
+    args = parser.parse_args(argv)
+
+    config = loadConfig(args.config)
+    if args.engine_url:
+        config['engine_url'] = args.engine_url
+    config['audio_format'] = args.format
+    config['append_audio'] = "true" if args.append else "false"
+    config['filename_template'] = args.filename_template or config.get('filename_template') or generation.DEFAULT_FILENAME_TEMPLATE
+    invalid_placeholders = generation.getInvalidPlaceholders(config['filename_template'])
+    if invalid_placeholders:
+        print(f"Unknown placeholder(s) in the filename template: {', '.join(invalid_placeholders)}. Valid placeholders: {', '.join(generation.FILENAME_PLACEHOLDERS)}", file=sys.stderr)
+        return 1
+
+    engine_url = generation.getEngineUrl(config)
+    if generation.getVersionOrNone(engine_url) is None:
+        print(f"VOICEVOX service is not running at {engine_url}", file=sys.stderr)
+        return 1
+    speakers = generation.getSpeakerList(generation.getSpeakersOrNone(engine_url) or [])
+    speaker = next((x for x in speakers if x[0] == args.speaker), None)
+    if speaker is None:
+        print(f"Speaker '{args.speaker}' not found. Available speakers: {', '.join(x[0] for x in speakers)}", file=sys.stderr)
+        return 1
+    style_name = args.style or speaker[1][0][0]
+
+    try:
+        accent_cache.SyncUserDict(config.get('user_dict') or [], engine_url)
+    except Exception as e:
+        print(f"Unable to update the VOICEVOX user dictionary, generating without it: {e}", file=sys.stderr)
+
+    if args.format != "wav":
+        ffmpeg.ffmpegInstaller.GetFFmpegIfNotExist()
+        if not ffmpeg.ffmpegInstaller.can_convert:
+            print("FFmpeg isn't available, audio will be saved as wav", file=sys.stderr)
+
+    col = Collection(args.collection)
+    try:
+        notes = [col.get_note(note_id) for note_id in col.find_notes(buildSearch(args.search, args.deck))]
+        notes = [note for note in notes if args.source in note and args.destination in note and note[args.source].strip()]
+        if args.skip_existing:
+            notes = [note for note in notes if not note[args.destination].strip()]
+
+        try:
+            planned_chunks = generation.PlanSpeakerChunks(notes, speakers, config.get('speaker_mapping') or [], args.speaker, style_name, args.chunk_size)
+        except Exception as e:
+            print(e, file=sys.stderr)
+            return 1
+
+        stats = generation.JobStats()
+
+        def printProgress(notes_so_far, total_notes, text=''):
+            if not text:
+                print(f"\rGenerating Audio {notes_so_far}/{total_notes} ({stats.getProgressText(notes_so_far, total_notes)})    ", end="", flush=True)
+
+        generated = generation.GenerateAudioForChunks(col, planned_chunks, args.source, args.destination, config, printProgress, concurrency=args.concurrency, stats=stats, accent_store=accent_cache.getDefaultStore())
+        print(f"\nGenerated audio for {generated} notes in {stats.getElapsed():.1f}s ({stats.getThroughput():.1f} notes/s)")
+        for stage, summary in stats.getStageSummary().items():
+            print(f"  {stage}: {summary['total']:.2f}s total, p50 {summary['p50'] * 1000:.1f}ms, p99 {summary['p99'] * 1000:.1f}ms")
+        report_info = {'collection': args.collection, 'notes': generated, 'chunk_size': args.chunk_size, 'concurrency': args.concurrency, 'format': args.format}
+        print(f"Report written to {stats.writeReport(args.report_dir, report_info)}")
+    finally:
+        col.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,7 +3,6 @@ import os
 import stat
 import requests
 import json
-from aqt import mw
 from anki.hooks import addHook
 import zipfile
 import subprocess
@@ -0,0 +1,531 @@
+# Everything needed to generate audio for notes that doesn't depend on the Anki window (no aqt/mw imports in here).
+# The browser dialog, the auto generation queue and cli.py are all built on top of this
+import requests
+import json
+import urllib.parse
+import uuid
+import re
+import zipfile
+import io
+import traceback
+import datetime
+import fnmatch
+import hashlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from . import ffmpeg
+from .job_stats import JobStats
+from .media_writer import MediaWriter
+
+DEFAULT_ENGINE_URL = "http://127.0.0.1:50021"
+DEFAULT_FILENAME_TEMPLATE = "VOICEVOX_{{speaker}}_{{style}}_{{uid}}"
+
+def getEngineUrl(config):
+    return (config.get('engine_url') or DEFAULT_ENGINE_URL).rstrip('/')
+
+def getVersionOrNone(engine_url=DEFAULT_ENGINE_URL):
+    try:
+        response = requests.get(engine_url + "/version", timeout=5)
+        if response.status_code == 200:
+            return response.content
+    except:
+        print("Request timed out!")
+    return None
+
+def getSpeakersOrNone(engine_url=DEFAULT_ENGINE_URL):
+    try:
+        speakers_response = requests.get(engine_url + "/speakers", timeout=5)
+        if speakers_response.status_code == 200:
+            return json.loads(speakers_response.content)
+    except:
+        return None
+
+def getSpeakerInfo(speaker_uuid, engine_url=DEFAULT_ENGINE_URL):
+    try:
+        speakers_response = requests.get(engine_url + "/speaker_info?speaker_uuid=" + str(speaker_uuid), timeout=5)
+        if speakers_response.status_code == 200:
+            return json.loads(speakers_response.content)
+    except:
+        return None
+
+def getSpeakerList(speaker_json):
+    speakers = []
+    for obj in speaker_json:
+        styles = []
+        for style in obj['styles']:
+            styles.append( (style['name'], style['id']) )
+        #speaker_info = getSpeakerInfo(obj['speaker_uuid'])
+        speakers.append( (obj['name'], styles, obj['speaker_uuid']) )
+    return speakers
+
+def getSpeakerStyle(speakers, speaker_name, style_name):
+    # Same lookup as getSpeaker but from plain names, for when there's no dialog around (e.g. auto generation).
+    # Returns (style_name, style_id) or None. A style_name of None means the speaker's first style
+    speaker = next((x for x in speakers if x[0] == speaker_name), None)
+    if speaker is None or not speaker[1]:
+        return None
+    if style_name is None:
+        return speaker[1][0]
+    return next((x for x in speaker[1] if x[0] == style_name), None)
+
+def getSpeakerIdByName(speakers, speaker_name, style_name):
+    style_info = getSpeakerStyle(speakers, speaker_name, style_name)
+    if style_info is None:
+        return None
+    return style_info[1]
+
+def matchesAnyPattern(value, patterns):
+    # Case insensitive wildcard match, so `japanese*` matches `Japanese::Sentences`
+    return any(fnmatch.fnmatch(value.lower(), pattern.lower()) for pattern in patterns)
+
+def getNoteDeckName(note):
+    cards_of_note = note.cards()
+    if cards_of_note:
+        return note.col.decks.name(cards_of_note[0].did)
+    return None
+
+def getMappedSpeakerName(note, speaker_mapping, default_speaker_name, default_style_name):
+    # The first rule in speaker_mapping that matches the note decides the speaker. Every condition in a rule is optional
+    # Example rule: {"deck": "Japanese::Anime*", "note_type": "", "field": "Gender", "value": "female", "speaker": "...", "style": "..."}
+    deck_name = None
+    for rule in speaker_mapping:
+        if rule.get('note_type') and not matchesAnyPattern(note.note_type()['name'], [rule['note_type']]):
+            continue
+        if rule.get('deck'):
+            if deck_name is None:
+                deck_name = getNoteDeckName(note) or ""
+            if not matchesAnyPattern(deck_name, [rule['deck']]):
+                continue
+        if rule.get('field'):
+            if rule['field'] not in note:
+                continue
+            if not matchesAnyPattern(getNoteText(note, rule['field']), [rule.get('value') or '*']):
+                continue
+        if rule.get('speaker') and rule['speaker'] != default_speaker_name:
+            # The style picked in the dialog belongs to another speaker, so a rule without a style gets this speaker's first one (None, see getSpeakerStyle)
+            return (rule['speaker'], rule.get('style') or None)
+        return (default_speaker_name, rule.get('style') or default_style_name)
+    return (default_speaker_name, default_style_name)
+
+def GroupNotesBySpeaker(notes, speaker_mapping, default_speaker_name, default_style_name):
+    # Returns {(speaker_name, style_name): [note, ...]} so every multi_synthesis call can be made with a single speaker.
+    # Grouping first instead of splitting chunks whenever the speaker changes keeps the chunks full no matter how the notes are ordered
+    groups = {}
+    for note in notes:
+        speaker_key = getMappedSpeakerName(note, speaker_mapping, default_speaker_name, default_style_name)
+        groups.setdefault(speaker_key, []).append(note)
+    return groups
+
+def getNoteText(note, source_field, ignore_brackets=True):
+    note_text = note[source_field]
+
+    # Remove html tags https://stackoverflow.com/a/19730306
+    tag_re = re.compile(r'(<!--.*?-->|<[^>]*>)')
+    entity_re = re.compile(r'(&[^;]+;)')
+
+    note_text = entity_re.sub('', note_text)
+    note_text = tag_re.sub('', note_text)
+
+    # Remove stuff between brackets. Usually japanese cards have pitch accent and reading info in brackets like 「 タイトル[;a,h] を 聞[き,きく;h]いた わけ[;a] じゃ ない[;a] ！」
+    if ignore_brackets:
+        note_text = re.sub("\[.*?\]", "", note_text)
+    note_text = re.sub(" ", "", note_text) # there's a lot of spaces for whatever reason which throws off the voice gen so we remove all spaces (japanese doesn't care about them anyway)
+
+    return note_text
+
+# Anki cuts media filenames at 120 bytes (not characters, a Japanese character is 3 bytes), stay a bit under that including the extension
+MAX_FILENAME_BYTES = 110
+
+def cleanFilenamePart(text: str, replacement: str = "_") -> str:
+    # Replace problematic characters with a replacement character
+    cleaned = re.sub(r'[<>:"/\\|?*\x00-\x1f]', replacement, text)
+    # Anki's media manager drops these, so drop them here and the name we write is the name Anki keeps
+    return re.sub(r'[\[\]^]', "", cleaned)
+
+def truncateBytes(text: str, max_bytes: int) -> str:
+    # Without cutting a character in half
+    return text.encode("utf8")[:max_bytes].decode("utf8", "ignore")
+
+def sanitize_filename(filename: str, replacement: str = "_", max_bytes: int = MAX_FILENAME_BYTES) -> str:
+    sanitized = truncateBytes(cleanFilenamePart(filename, replacement), max_bytes)
+    # Strip leading and trailing whitespaces and dots (Windows hates these)
+    return sanitized.strip().strip(".")
+
+TEXT_PLACEHOLDER_BYTES = 48
+# Everything that can go between {{ }} in the filename template, with the description shown in the dialog
+FILENAME_PLACEHOLDERS = collections.OrderedDict([
+    ("uid", "random unique identifier"),
+    ("hash", "hash of the generated audio before it's encoded, the same audio always gets the same name"),
+    ("nid", "id of the note"),
+    ("speaker", "speaker name"),
+    ("style", "speaking style"),
+    ("deck", "card deck name"),
+    ("deck-full", "full card deck name, including parent deck hierarchy"),
+    ("date", "current date in ISO format"),
+    ("text", f"the text that was read out (the first {TEXT_PLACEHOLDER_BYTES // 3} Japanese characters)"),
+    ("field:<fieldName>", "replaces with note field content"),
+])
+# Placeholders that make every file name unique by themselves, with the most bytes they can take up
+UNIQUE_PLACEHOLDER_BYTES = {"uid": 36, "hash": 16, "nid": 13}
+
+def splitFilenameTemplate(template):
+    # "A_{{speaker}}_{{field:Front}}" -> ["A_", "speaker", "_", "field:Front", ""], placeholders are at the odd indices
+    return re.split(r"{{(.*?)}}", template)
+
+def getInvalidPlaceholders(template, field_names=None):
+    # Placeholders the template uses that won't be filled in. Fields are only checked when field_names is given
+    invalids = []
+    for placeholder in splitFilenameTemplate(template)[1::2]:
+        if placeholder.startswith("field:"):
+            if field_names is not None and placeholder[len("field:"):].strip() not in field_names:
+                invalids.append(placeholder)
+        elif placeholder not in FILENAME_PLACEHOLDERS:
+            invalids.append(placeholder)
+    return invalids
+
+def hasUniquePlaceholder(template):
+    # FilenameTemplate shortens the other placeholders to fit Anki's filename limit but never the unique ones,
+    # so this only fails when the unique ones plus the plain text in the template don't fit by themselves
+    parts = splitFilenameTemplate(template)
+    unique_placeholders = [placeholder for placeholder in parts[1::2] if placeholder in UNIQUE_PLACEHOLDER_BYTES]
+    if not unique_placeholders:
+        return False
+    fixed_bytes = sum(len(cleanFilenamePart(text).encode("utf8")) for text in parts[0::2]) + sum(UNIQUE_PLACEHOLDER_BYTES[placeholder] for placeholder in unique_placeholders)
+    return fixed_bytes <= MAX_FILENAME_BYTES - len(".opus")
+
+FilenameClip = collections.namedtuple("FilenameClip", ["note", "speaker_name", "style_name", "text", "wav_hash"])
+
+class FilenameTemplate:
+    # The template is parsed once per job and every placeholder it uses is looked up once, naming a clip then only runs those
+    def __init__(self, template):
+        parts = splitFilenameTemplate(template)
+        self.texts = [cleanFilenamePart(text) for text in parts[0::2]]
+        self.placeholders = parts[1::2]
+        # Same date for the whole job even if it runs past midnight
+        self.date = datetime.datetime.now().date().isoformat()
+        self.getters = {placeholder: self.getGetter(placeholder) for placeholder in set(self.placeholders)}
+        # What gets shortened when a name is too long, the placeholder used last first. The unique ones are left alone
+        self.placeholder_counts = collections.Counter(self.placeholders)
+        self.shorten_order = [placeholder for placeholder in dict.fromkeys(reversed(self.placeholders)) if placeholder not in UNIQUE_PLACEHOLDER_BYTES]
+
+    def getGetter(self, placeholder):
+        if placeholder.startswith("field:"):
+            field_name = placeholder[len("field:"):]
+            return lambda clip: clip.note[field_name] if field_name in clip.note else ""
+        getters = {
+            "uid": lambda clip: str(uuid.uuid4()),
+            "hash": lambda clip: clip.wav_hash[:UNIQUE_PLACEHOLDER_BYTES["hash"]],
+            "nid": lambda clip: str(clip.note.id),
+            "speaker": lambda clip: clip.speaker_name,
+            "style": lambda clip: clip.style_name,
+            "deck": lambda clip: (getNoteDeckName(clip.note) or "UnknownDeck").split("::")[-1],
+            "deck-full": lambda clip: getNoteDeckName(clip.note) or "UnknownDeck",
+            "date": lambda clip: self.date,
+            "text": lambda clip: truncateBytes(clip.text, TEXT_PLACEHOLDER_BYTES),
+        }
+        return getters.get(placeholder, lambda clip: "")
+
+    def render(self, values):
+        parts = [None] * (len(self.texts) + len(self.placeholders))
+        parts[0::2] = self.texts
+        parts[1::2] = [values[placeholder] for placeholder in self.placeholders]
+        return "".join(parts)
+
+    def getFilename(self, note, audio_extension, speaker_name, style_name, text="", wav_hash=""):
+        # wav_hash comes from SynthesizeChunk
+        clip = FilenameClip(note, speaker_name, style_name, text, wav_hash)
+        values = {placeholder: cleanFilenamePart(getter(clip)) for placeholder, getter in self.getters.items()}
+        max_bytes = MAX_FILENAME_BYTES - len(audio_extension) - 1
+        # Too long for Anki: shorten the other placeholders so the part that makes the name unique doesn't get cut off
+        overflow = len(self.render(values).encode("utf8")) - max_bytes
+        for placeholder in self.shorten_order:
+            if overflow <= 0:
+                break
+            count = self.placeholder_counts[placeholder]
+            value_bytes = len(values[placeholder].encode("utf8"))
+            values[placeholder] = truncateBytes(values[placeholder], max(0, value_bytes - (overflow + count - 1) // count))
+            overflow -= (value_bytes - len(values[placeholder].encode("utf8"))) * count
+        # We'll add the final extension here
+        return f"{sanitize_filename(self.render(values), max_bytes=max_bytes)}.{audio_extension}"
+
+def ApplyAudioSettings(audio_query, config):
+    # Slider values from the dialog are stored as percentages
+    if config.get('speed_slider_value'):
+        audio_query['speedScale'] = config.get('speed_slider_value') / 100;
+    if config.get('volume_slider_value'):
+        audio_query['volumeScale'] = config.get('volume_slider_value') / 100;
+    if config.get('pitch_slider_value'):
+        audio_query['pitchScale'] = config.get('pitch_slider_value') / 100;
+    if config.get('intonation_slider_value'):
+        audio_query['intonationScale'] = config.get('intonation_slider_value') / 100;
+    if config.get('initial_silence_slider_value'):
+        audio_query['prePhonemeLength'] = config.get('initial_silence_slider_value') / 100;
+    if config.get('final_silence_slider_value'):
+        audio_query['postPhonemeLength'] = config.get('final_silence_slider_value') / 100;
+    return audio_query
+
+def MakeAudioQuery(accent_phrases, kana=""):
+    # Same defaults /audio_query uses, for when we already have the accent phrases and don't need the engine to analyze the text
+    return {
+        "accent_phrases": accent_phrases,
+        "speedScale": 1.0,
+        "pitchScale": 0.0,
+        "intonationScale": 1.0,
+        "volumeScale": 1.0,
+        "prePhonemeLength": 0.1,
+        "postPhonemeLength": 0.1,
+        "outputSamplingRate": 24000,
+        "outputStereo": False,
+        "kana": kana,
+    }
+
+def GenerateAudioQuery(text_and_speaker_index_tuple, config, accent_store=None):
+    audio_query_response = None
+    try:
+        text = text_and_speaker_index_tuple[0]
+        speaker_index = text_and_speaker_index_tuple[1]
+        corrected = accent_store.get(text) if accent_store is not None else None
+        if corrected is not None:
+            # The user fixed the pronunciation of this text, so skip text analysis and reuse their accent phrases.
+            # Only the pitch and length of each mora come from the engine because those depend on the speaker
+            accent_phrases = GetMoraData(corrected['accent_phrases'], speaker_index, getEngineUrl(config))
+            if accent_phrases is None:
+                raise Exception(f"Unable to get mora data for the corrected pronunciation of `{text}`")
+            j = MakeAudioQuery(accent_phrases, corrected.get('kana', ''))
+        else:
+            audio_query_response = requests.post(getEngineUrl(config) + "/audio_query?speaker=" + str(speaker_index) + "&text=" + urllib.parse.quote(text, safe=''))
+            if audio_query_response.status_code != 200:
+                raise Exception(f"Unable to generate audio for the following text: `{text}`. Response code was {audio_query_response.status_code}\nResponse:{audio_query_response.text}")
+            j = json.loads(audio_query_response.text)
+        j = ApplyAudioSettings(j, config)
+        result = json.dumps(j, ensure_ascii=False).encode('utf8')
+        return result
+    except Exception as e:
+        raise Exception(f"Unable to generate audio for the following text: `{text}`.\nResponse: {audio_query_response.text if audio_query_response is not None else 'None'}\n{traceback.format_exc()}")
+
+def GetAccentPhrases(text, speaker_index, engine_url=DEFAULT_ENGINE_URL, is_kana=False):
+    # With is_kana the text is read as AquesTalk style kana (e.g. コンニチワ'), that's how pronunciation fixes are entered
+    response = requests.post(engine_url + "/accent_phrases?speaker=" + str(speaker_index) + "&text=" + urllib.parse.quote(text, safe='') + ("&is_kana=true" if is_kana else ""))
+    if response.status_code != 200:
+        raise Exception(f"VOICEVOX couldn't read `{text}`. Response code was {response.status_code}\nResponse:{response.text}")
+    return json.loads(response.content)
+
+def GetMoraData(accent_phrases, speaker_index, engine_url=DEFAULT_ENGINE_URL):
+    response = requests.post(engine_url + "/mora_data?speaker=" + str(speaker_index), data=json.dumps(accent_phrases, ensure_ascii=False).encode('utf8'), headers={"Content-Type": "application/json"})
+    if response.status_code != 200:
+        return None
+    return json.loads(response.content)
+
+def GetUserDict(engine_url=DEFAULT_ENGINE_URL):
+    # Returns {word_uuid: word}
+    response = requests.get(engine_url + "/user_dict", timeout=5)
+    if response.status_code != 200:
+        raise Exception(f"Unable to get the VOICEVOX user dictionary. Response code was {response.status_code}\nResponse:{response.text}")
+    return json.loads(response.content)
+
+def getUserDictWordParams(word):
+    params = {'surface': word['surface'], 'pronunciation': word['pronunciation'], 'accent_type': word.get('accent_type', 0)}
+    if word.get('word_type'):
+        params['word_type'] = word['word_type']
+    if word.get('priority') is not None:
+        params['priority'] = word['priority']
+    return params
+
+def AddUserDictWord(word, engine_url=DEFAULT_ENGINE_URL):
+    response = requests.post(engine_url + "/user_dict_word", params=getUserDictWordParams(word))
+    if response.status_code != 200:
+        raise Exception(f"Unable to add `{word['surface']}` to the VOICEVOX user dictionary. Response code was {response.status_code}\nResponse:{response.text}")
+
+def UpdateUserDictWord(word_uuid, word, engine_url=DEFAULT_ENGINE_URL):
+    response = requests.put(engine_url + "/user_dict_word/" + word_uuid, params=getUserDictWordParams(word))
+    if response.status_code not in (200, 204):
+        raise Exception(f"Unable to update `{word['surface']}` in the VOICEVOX user dictionary. Response code was {response.status_code}\nResponse:{response.text}")
+
+def SynthesizeAudio(audio_query_json, speaker_index, engine_url=DEFAULT_ENGINE_URL):
+    synthesis_response = requests.post(engine_url + "/synthesis?speaker=" + str(speaker_index), data=audio_query_json)
+    if synthesis_response.status_code != 200:
+        return None
+    return synthesis_response.content
+
+def MultiSynthesizeAudio(audio_queries, speaker_index, engine_url=DEFAULT_ENGINE_URL): # NOTE: This returns a zip
+    for q in audio_queries:
+        if q is None:
+            raise Exception("MultiSynthesizeAudio recieved an audio query that was None")
+    # Create json array of queries
+    combined = b"[" + b','.join(audio_queries) + b"]"
+
+    synthesis_response = requests.post(engine_url + "/multi_synthesis?speaker=" + str(speaker_index), data=combined)
+    if synthesis_response.status_code != 200:
+        return None
+    return synthesis_response.content
+
+def DivideIntoChunks(array, n):
+    # looping till length l
+    for i in range(0, len(array), n):
+        yield array[i:i + n]
+
+def getAudioFormat(config):
+    # audio_format is only set by the command line, the dialog just has the opus checkbox
+    return config.get('audio_format') or ("opus" if config.get('use_opus') == "true" else "mp3")
+
+def SynthesizeChunk(note_texts, speaker_index, config, progress_callback=None, stats=None, chunk_index=None, accent_store=None):
+    # Turns a list of note texts into a list of (audio_data, audio_extension, wav_hash) in the same order.
+    # wav_hash is the sha1 of the audio before it's encoded, encoders like ffmpeg's ogg muxer don't give the same bytes for the same audio every time
+    # This doesn't touch the collection so it's safe to call from a background thread as long as progress_callback is None
+    stats = stats or JobStats()
+    def report(text):
+        if progress_callback is not None:
+            progress_callback(text)
+
+    audio_queries = []
+    for query_count, text in enumerate(note_texts):
+        report(f"Audio Query: {query_count}/{len(note_texts)}")
+        if accent_store is not None and accent_store.get(text) is not None:
+            stats.count('accent_cache_hits')
+        with stats.measure("audio_query", chunk_index, query_count):
+            audio_queries.append(GenerateAudioQuery((text, speaker_index), config, accent_store))
+
+    report(f"Synthesizing Audio: {len(note_texts)} notes")
+    with stats.measure("synthesis", chunk_index):
+        zip_bytes = MultiSynthesizeAudio(audio_queries, speaker_index, getEngineUrl(config))
+    if zip_bytes is None:
+        raise Exception(f"VOICEVOX failed to synthesize audio for the following text: {note_texts}")
+
+    new_audio_format = getAudioFormat(config)
+    results = [None] * len(note_texts)
+    # MultiSynthesis returns zip bytes with ZIP_STORED
+    with zipfile.ZipFile(io.BytesIO(zip_bytes), "r", zipfile.ZIP_STORED) as wavs_zip:
+        for zip_counter, name in enumerate(wavs_zip.namelist()):
+            report(f"Converting Audio: {zip_counter}/{len(note_texts)}")
+            chunk_note_index = int(name.replace('.wav', '')) - 1 # Starts at 001.wav, this converts to 0 index
+            with stats.measure("zip_unpack", chunk_index, chunk_note_index):
+                audio_data = wavs_zip.read(name)
+            stats.count('wav_bytes', len(audio_data))
+            wav_hash = hashlib.sha1(audio_data).hexdigest()
+
+            audio_extension = "wav"
+            new_audio_data = None
+            if new_audio_format != "wav":
+                with stats.measure("encode", chunk_index, chunk_note_index):
+                    new_audio_data = ffmpeg.ConvertWav(audio_data, new_audio_format)
+            if new_audio_data != None:
+                audio_data = new_audio_data
+                audio_extension = new_audio_format
+            results[chunk_note_index] = (audio_data, audio_extension, wav_hash)
+    stats.count('chunks')
+    return results
+
+def getNotesWithAudio(col, note_ids, filenames, destination_field, append_audio):
+    # Points the destination field of every note at its audio file (filenames as returned by MediaWriter), the notes aren't saved yet
+    notes = []
+    for note_id, filename in zip(note_ids, filenames):
+        note = col.get_note(note_id)
+        audio_field_text = f"[sound:{filename}]"
+        if append_audio:
+            note[destination_field] += audio_field_text
+        else:
+            note[destination_field] = audio_field_text
+        notes.append(note)
+    return notes
+
+def UpdateNotesWithAudio(col, note_ids, filenames, destination_field, append_audio, stats=None, chunk_index=None):
+    # Same as getNotesWithAudio but saves them all at once
+    stats = stats or JobStats()
+    notes = getNotesWithAudio(col, note_ids, filenames, destination_field, append_audio)
+    with stats.measure("note_update", chunk_index):
+        col.update_notes(notes)
+    stats.count('notes', len(notes))
+
+def PlanSpeakerChunks(notes, speakers, speaker_mapping, default_speaker_name, default_style_name, chunk_size):
+    # Returns [(speaker_index, speaker_name, style_name, [note, ...]), ...] ready to be handed to GenerateAudioForChunks.
+    # Every speaker is looked up before generating anything so a typo in the mapping doesn't leave the job half done
+    planned_chunks = []
+    for (speaker_name, style_name), group in GroupNotesBySpeaker(notes, speaker_mapping, default_speaker_name, default_style_name).items():
+        style_info = getSpeakerStyle(speakers, speaker_name, style_name)
+        if style_info is None:
+            raise Exception(f"VOICEVOX doesn't have speaker '{speaker_name}' with style '{style_name}'")
+        style_name, speaker_index = style_info
+        for note_chunk in DivideIntoChunks(group, chunk_size):
+            planned_chunks.append((speaker_index, speaker_name, style_name, note_chunk))
+    return planned_chunks
+
+def GenerateAudioForChunks(col, planned_chunks, source_field, destination_field, config, progress_callback=None, ignore_brackets=True, concurrency=1, stats=None, accent_store=None):
+    # progress_callback(notes_so_far, total_notes, text) is always called from the calling thread.
+    # With concurrency > 1 several chunks are synthesized at once on worker threads, but notes are still saved in order from the calling thread.
+    # Pass in a JobStats to see where the time went afterwards (or live, from progress_callback).
+    # accent_store (see accent_cache.py) holds the user's pronunciation fixes, texts in there skip /audio_query
+    stats = stats or JobStats()
+    total_notes = sum(len(note_chunk) for (_, _, _, note_chunk) in planned_chunks)
+    notes_so_far = 0
+    filename_template = FilenameTemplate(config.get("filename_template") or DEFAULT_FILENAME_TEMPLATE)
+    append_audio = config.get('append_audio') == "true"
+
+    def report(text=''):
+        if progress_callback is not None:
+            progress_callback(notes_so_far, total_notes, text)
+
+    # Only the plain text is handed to the workers, the collection is never touched off this thread
+    chunk_texts = []
+    for chunk_index, (_, _, _, note_chunk) in enumerate(planned_chunks):
+        texts = []
+        for note_index, note in enumerate(note_chunk):
+            with stats.measure("text_normalization", chunk_index, note_index):
+                texts.append(getNoteText(note, source_field, ignore_brackets))
+        chunk_texts.append(texts)
+
+    def synthesizedChunks():
+        if concurrency <= 1:
+            for chunk_index, (texts, (speaker_index, _, _, _)) in enumerate(zip(chunk_texts, planned_chunks)):
+                yield SynthesizeChunk(texts, speaker_index, config, report, stats, chunk_index, accent_store)
+            return
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # Only keep a few chunks in flight so a big collection doesn't end up entirely in memory
+            in_flight = collections.deque()
+            for chunk_index, (texts, (speaker_index, _, _, _)) in enumerate(zip(chunk_texts, planned_chunks)):
+                in_flight.append(executor.submit(SynthesizeChunk, texts, speaker_index, config, None, stats, chunk_index, accent_store))
+                if len(in_flight) >= concurrency * 2:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+
+    # Writing a chunk's files happens on the media writer's thread while the next chunk is being synthesized,
+    # the notes are only updated once their files are in place
+    media_writer = MediaWriter(col, stats)
+    # (chunk_index, note_ids, write_future) for chunks whose files are being written but whose notes haven't been updated yet
+    pending_writes = collections.deque()
+
+    def finishWrite():
+        nonlocal notes_so_far
+        chunk_index, note_ids, write_future = pending_writes.popleft()
+        UpdateNotesWithAudio(col, note_ids, write_future.result(), destination_field, append_audio, stats, chunk_index)
+        notes_so_far += len(note_ids)
+        report()
+
+    report()
+    try:
+        for chunk_index, ((speaker_index, speaker_name, style_name, note_chunk), audio_results) in enumerate(zip(planned_chunks, synthesizedChunks())):
+            clips = []
+            for note_index, (note, text, (audio_data, audio_extension, wav_hash)) in enumerate(zip(note_chunk, chunk_texts[chunk_index], audio_results)):
+                with stats.measure("filename", chunk_index, note_index):
+                    clips.append((filename_template.getFilename(note, audio_extension, speaker_name, style_name, text, wav_hash), audio_data))
+            pending_writes.append((chunk_index, [note.id for note in note_chunk], media_writer.writeBatch(clips, chunk_index)))
+            # Keep one chunk writing while the next one is synthesized
+            while len(pending_writes) > 1:
+                finishWrite()
+        while pending_writes:
+            finishWrite()
+    except Exception:
+        # A later chunk failed, still hand the files that already made it to disk to their notes instead of leaving them unused
+        while pending_writes:
+            if pending_writes[0][2].exception() is not None:
+                pending_writes.popleft()
+                continue
+            try:
+                finishWrite()
+            except Exception:
+                traceback.print_exc()
+        raise
+    finally:
+        media_writer.close()
+    stats.finish()
+    return notes_so_far
@@ -0,0 +1,130 @@
+# Timing for a generation job: how long every stage took per chunk and per note, plus a few counters.
+# Used for the ETA/throughput in the progress window and for the report written when a job finishes
+import collections
+import contextlib
+import csv
+import datetime
+import json
+import math
+import os
+import threading
+import time
+from os.path import join
+
+# Upper bounds in milliseconds for the histogram buckets in the report
+HISTOGRAM_BUCKETS_MS = [1, 5, 10, 50, 100, 500, 1000, 5000, 10000]
+
+def percentile(values, p):
+    # Nearest rank percentile, values doesn't need to be sorted
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, math.ceil(p * len(values) / 100) - 1))
+    return values[index]
+
+def formatDuration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds % 3600 // 60:02}:{seconds % 60:02}"
+    return f"{seconds // 60}:{seconds % 60:02}"
+
+class JobStats:
+    def __init__(self):
+        # Stages can be timed from worker threads when generating with concurrency > 1
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.started_at = datetime.datetime.now()
+        self.end_time = None
+        self.counters = collections.Counter()
+        self.stage_times = collections.defaultdict(list)
+        # Every single timing as (stage, seconds, chunk index, note index within the chunk or None for chunk level stages)
+        self.records = []
+
+    @contextlib.contextmanager
+    def measure(self, stage, chunk=None, note=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addTime(stage, time.perf_counter() - start, chunk, note)
+
+    def addTime(self, stage, seconds, chunk=None, note=None):
+        with self.lock:
+            self.stage_times[stage].append(seconds)
+            self.records.append((stage, seconds, chunk, note))
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def finish(self):
+        self.end_time = time.perf_counter()
+
+    def getElapsed(self):
+        return (self.end_time or time.perf_counter()) - self.start_time
+
+    def getThroughput(self):
+        # Notes per second so far
+        elapsed = self.getElapsed()
+        if elapsed <= 0:
+            return 0.0
+        return self.counters['notes'] / elapsed
+
+    def getEtaSeconds(self, notes_so_far, total_notes):
+        throughput = self.getThroughput()
+        if throughput <= 0:
+            return None
+        return (total_notes - notes_so_far) / throughput
+
+    def getProgressText(self, notes_so_far, total_notes):
+        eta = self.getEtaSeconds(notes_so_far, total_notes)
+        if eta is None:
+            return "Estimating time left..."
+        return f"{self.getThroughput():.1f} notes/s, about {formatDuration(eta)} left"
+
+    def getStageSummary(self):
+        summary = {}
+        with self.lock:
+            stage_times = {stage: list(times) for stage, times in self.stage_times.items()}
+        for stage, times in stage_times.items():
+            histogram = collections.OrderedDict((f"<={bucket}ms", 0) for bucket in HISTOGRAM_BUCKETS_MS)
+            histogram[f">{HISTOGRAM_BUCKETS_MS[-1]}ms"] = 0
+            for seconds in times:
+                bucket = next((f"<={bucket}ms" for bucket in HISTOGRAM_BUCKETS_MS if seconds * 1000 <= bucket), f">{HISTOGRAM_BUCKETS_MS[-1]}ms")
+                histogram[bucket] += 1
+            summary[stage] = {
+                'count': len(times),
+                'total': sum(times),
+                'mean': sum(times) / len(times),
+                'p50': percentile(times, 50),
+                'p90': percentile(times, 90),
+                'p99': percentile(times, 99),
+                'max': max(times),
+                'histogram': histogram,
+            }
+        return summary
+
+    def toDict(self, info=None):
+        return {
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'seconds': self.getElapsed(),
+            'notes_per_second': self.getThroughput(),
+            'info': info or {},
+            'counters': dict(self.counters),
+            'stages': self.getStageSummary(),
+        }
+
+    def writeReport(self, directory, info=None):
+        # Writes <timestamp>.json with the summary and <timestamp>.csv with every single timing, returns the json path
+        os.makedirs(directory, exist_ok=True)
+        base_path = join(directory, "voicevox_job_" + self.started_at.strftime("%Y%m%d_%H%M%S"))
+        with open(base_path + ".json", "w", encoding="utf8") as f:
+            json.dump(self.toDict(info), f, indent=2, ensure_ascii=False)
+        with self.lock:
+            records = list(self.records)
+        with open(base_path + ".csv", "w", encoding="utf8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["stage", "seconds", "chunk", "note"])
+            for stage, seconds, chunk, note in records:
+                writer.writerow([stage, f"{seconds:.6f}", "" if chunk is None else chunk, "" if note is None else note])
+        return base_path + ".json"
@@ -0,0 +1,57 @@
+# Saves generated audio into the collection's media folder on a worker thread, a batch (chunk) at a time,
+# so writing one chunk overlaps with synthesizing the next
+import os
+import tempfile
+from os.path import join, exists
+from concurrent.futures import ThreadPoolExecutor
+from .job_stats import JobStats
+
+class MediaWriter:
+    def __init__(self, col, stats=None):
+        self.col = col
+        self.stats = stats or JobStats()
+        # A single worker keeps the writes in order and off the collection's thread
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def writeBatch(self, clips, chunk_index=None):
+        # clips is [(desired_filename, data), ...]. Returns a Future with the filenames that were actually used, in the same order.
+        # The name can differ from the desired one when another file already has that name, so always use the returned names
+        return self.executor.submit(self.writeClips, clips, chunk_index)
+
+    def writeClips(self, clips, chunk_index):
+        filenames = []
+        for note_index, (filename, data) in enumerate(clips):
+            with self.stats.measure("media_write", chunk_index, note_index):
+                filenames.append(self.writeFile(filename, data))
+            self.stats.count('audio_bytes', len(data))
+        return filenames
+
+    def writeFile(self, filename, data):
+        media_dir = self.col.media.dir()
+        path = join(media_dir, filename)
+        wrote_file = False
+        if not exists(path):
+            # Write to a temp file and rename it into place so a crash never leaves half a file with the real name behind
+            fd, temp_path = tempfile.mkstemp(prefix=".voicevox_", suffix=".tmp", dir=media_dir)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+            except Exception:
+                if exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            wrote_file = True
+        # Let the media manager have the final say. When the file on disk already has the same content under the name it wants (always the case
+        # after the rename above unless it changes the name) it keeps it as is, otherwise it writes the data itself under a new unique name
+        actual_filename = self.col.media.write_data(filename, data)
+        if wrote_file and actual_filename != filename:
+            # Anki wrote its own copy under another name (sanitize_filename should prevent that), don't leave ours behind as an unused file.
+            # On case insensitive filesystems a name that only differs in case is still our file though
+            actual_path = join(media_dir, actual_filename)
+            if not (exists(actual_path) and os.path.samefile(path, actual_path)):
+                os.remove(path)
+        return actual_filename
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,156 @@
+from aqt import mw, qt
+from aqt.qt import QLabel, QLineEdit, QMessageBox
+from aqt.sound import av_player
+from aqt.utils import tooltip
+from os.path import join, dirname
+import json
+from . import generation
+from . import accent_cache
+
+KANA_TOOLTIP = (
+    "The reading in VOICEVOX's kana notation:\n"
+    "  katakana only, ' after the mora that carries the accent\n"
+    "  / or 、 separates accent phrases (、 adds a pause)\n"
+    "  _ before a mora makes it unvoiced, ? at the end makes it a question\n\n"
+    "Example: コンニチワ'/セ'カイ"
+)
+
+class PronunciationDialog(qt.QDialog):
+    def __init__(self, note, parent=None) -> None:
+        super().__init__(parent)
+        self.note = note
+        self.config = mw.addonManager.getConfig(__name__)
+        self.engine_url = generation.getEngineUrl(self.config)
+        self.store = accent_cache.getDefaultStore()
+        self.setWindowTitle("Fix VOICEVOX Pronunciation")
+
+        # Preview with whatever was last used in the generate dialog
+        speakers = generation.getSpeakerList(generation.getSpeakersOrNone(self.engine_url) or [])
+        self.speaker_index = generation.getSpeakerIdByName(speakers, self.config.get('last_speaker_name'), self.config.get('last_style_name'))
+        if self.speaker_index is None and speakers:
+            self.speaker_index = speakers[0][1][0][1]
+
+        layout = qt.QVBoxLayout()
+        grid_layout = qt.QGridLayout()
+
+        grid_layout.addWidget(QLabel("Field: "), 0, 0)
+        self.field_combo = qt.QComboBox()
+        last_source_field = self.config.get('last_source_field')
+        for field in note.keys():
+            self.field_combo.addItem(field)
+        if last_source_field in note.keys():
+            self.field_combo.setCurrentIndex(note.keys().index(last_source_field))
+        grid_layout.addWidget(self.field_combo, 0, 1)
+
+        grid_layout.addWidget(QLabel("Text: "), 1, 0)
+        self.text_label = QLabel()
+        self.text_label.setTextInteractionFlags(qt.Qt.TextInteractionFlag.TextSelectableByMouse)
+        grid_layout.addWidget(self.text_label, 1, 1)
+
+        reading_label = QLabel("Reading: ")
+        reading_label.setToolTip(KANA_TOOLTIP)
+        grid_layout.addWidget(reading_label, 2, 0)
+        self.kana_edit = QLineEdit()
+        self.kana_edit.setToolTip(KANA_TOOLTIP)
+        grid_layout.addWidget(self.kana_edit, 2, 1)
+
+        self.status_label = QLabel()
+        grid_layout.addWidget(self.status_label, 3, 1)
+        layout.addLayout(grid_layout)
+
+        button_layout = qt.QHBoxLayout()
+        self.preview_button = qt.QPushButton("Preview")
+        self.preview_button.clicked.connect(self.Preview)
+        button_layout.addWidget(self.preview_button)
+
+        self.reset_button = qt.QPushButton("Use VOICEVOX's reading")
+        self.reset_button.setToolTip("Forget the fix for this text")
+        self.reset_button.clicked.connect(self.Reset)
+        button_layout.addWidget(self.reset_button)
+
+        self.save_button = qt.QPushButton("Save")
+        self.save_button.setToolTip("Use this reading every time audio is generated for this exact text. Regenerate the audio to apply it")
+        self.save_button.clicked.connect(self.Save)
+        button_layout.addWidget(self.save_button)
+
+        self.close_button = qt.QPushButton("Close")
+        self.close_button.clicked.connect(self.reject)
+        button_layout.addWidget(self.close_button)
+        layout.addLayout(button_layout)
+
+        self.setLayout(layout)
+
+        self.field_combo.currentIndexChanged.connect(self.LoadReading)
+        self.LoadReading()
+
+    def getText(self):
+        return generation.getNoteText(self.note, self.field_combo.itemText(self.field_combo.currentIndex()))
+
+    def LoadReading(self, *args):
+        text = self.getText()
+        self.text_label.setText(text)
+        entry = self.store.get(text)
+        if entry is not None:
+            self.kana_edit.setText(entry['kana'])
+            self.status_label.setText("Using your fixed reading")
+            self.reset_button.setEnabled(True)
+            return
+        self.reset_button.setEnabled(False)
+        if not text:
+            self.kana_edit.setText("")
+            self.status_label.setText("This field is empty")
+            return
+        try:
+            audio_query = json.loads(generation.GenerateAudioQuery((text, self.speaker_index), self.config))
+            self.kana_edit.setText(audio_query.get('kana', ''))
+            self.status_label.setText("Using VOICEVOX's reading")
+        except Exception as e:
+            self.kana_edit.setText("")
+            self.status_label.setText(f"VOICEVOX couldn't read this text: {e}")
+
+    def getAccentPhrasesOrNone(self):
+        try:
+            return generation.GetAccentPhrases(self.kana_edit.text(), self.speaker_index, self.engine_url, is_kana=True)
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"VOICEVOX doesn't understand this reading. Hover over the reading box for how to write it.\n\n{e}")
+            return None
+
+    def Preview(self):
+        accent_phrases = self.getAccentPhrasesOrNone()
+        if accent_phrases is None:
+            return
+        audio_query = generation.ApplyAudioSettings(generation.MakeAudioQuery(accent_phrases, self.kana_edit.text()), self.config)
+        contents = generation.SynthesizeAudio(json.dumps(audio_query, ensure_ascii=False).encode('utf8'), self.speaker_index, self.engine_url)
+        if contents is None:
+            QMessageBox.critical(self, "Error", "VOICEVOX failed to synthesize the preview")
+            return
+
+        preview_path = join(dirname(__file__), "VOICEVOX_preview.wav")
+        with open(preview_path, "wb") as f:
+            f.write(contents)
+        av_player.play_file(preview_path)
+
+    def Save(self):
+        text = self.getText()
+        if not text:
+            return
+        accent_phrases = self.getAccentPhrasesOrNone()
+        if accent_phrases is None:
+            return
+        self.store.set(text, accent_phrases, self.kana_edit.text())
+        tooltip("Saved. Regenerate the audio for this note to hear the fix")
+        self.LoadReading()
+
+    def Reset(self):
+        self.store.remove(self.getText())
+        self.LoadReading()
+
+def onFixPronunciationSelected(browser):
+    selected_notes = browser.selectedNotes()
+    if not selected_notes:
+        return
+    if generation.getVersionOrNone(generation.getEngineUrl(mw.addonManager.getConfig(__name__))) is None:
+        QMessageBox.critical(mw, "Error", f"VOICEVOX service is not running. Navigate to your VOICEVOX install and run 'run.exe'. You can download VOICEVOX from https://voicevox.hiroshiba.jp/ if you do not have it installed")
+        return
+    dialog = PronunciationDialog(mw.col.get_note(selected_notes[0]), browser)
+    dialog.exec()
@@ -0,0 +1,73 @@
+import importlib
+import re
+import sys
+from os.path import abspath, basename, dirname
+
+import pytest
+
+# generation imports ffmpeg which needs anki, import the addon by its folder name like bench/run_bench.py does
+pytest.importorskip("anki")
+ADDON_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, dirname(ADDON_DIR))
+from anki.collection import Collection # has to come before anything imports anki.hooks
+generation = importlib.import_module(basename(ADDON_DIR) + ".generation")
+
+UID_RE = r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+LONG_TEXT = "今日は天気がとても良いので公園に散歩に行きましょう" * 4
+WAV_HASH = "0123456789abcdef0123456789abcdef01234567"
+
+class FakeNote(dict):
+    # Just enough of anki's Note for FilenameTemplate, without cards there's no deck
+    id = 1700000000123
+
+    def cards(self):
+        return []
+
+def getFilename(template, note=None, extension="mp3", text=LONG_TEXT):
+    note = note if note is not None else FakeNote(Front=LONG_TEXT)
+    return generation.FilenameTemplate(template).getFilename(note, extension, "四国めたん", "ノーマル", text, WAV_HASH)
+
+def byteLength(filename):
+    return len(filename.encode("utf8"))
+
+def test_short_name_is_untouched():
+    assert getFilename("VOICEVOX_{{speaker}}_{{style}}_{{nid}}") == "VOICEVOX_四国めたん_ノーマル_1700000000123.mp3"
+
+def test_long_text_before_uid_keeps_the_uid():
+    filename = getFilename("{{speaker}}_{{style}}_{{text}}_{{uid}}")
+    assert byteLength(filename) <= generation.MAX_FILENAME_BYTES
+    assert re.fullmatch(r"四国めたん_ノーマル_.+_" + UID_RE + r"\.mp3", filename)
+
+def test_long_field_before_hash_and_nid_keeps_them():
+    filename = getFilename("{{field:Front}}_{{hash}}_{{nid}}", extension="opus")
+    assert byteLength(filename) <= generation.MAX_FILENAME_BYTES
+    assert filename.endswith(f"_{WAV_HASH[:16]}_1700000000123.opus")
+    assert filename.startswith("今日は")
+
+def test_text_is_capped_in_bytes():
+    filename = getFilename("{{text}}")
+    assert byteLength(filename[:-len(".mp3")]) <= generation.TEXT_PLACEHOLDER_BYTES
+
+def test_repeated_placeholder_is_shortened_evenly():
+    filename = getFilename("{{field:Front}}{{field:Front}}_{{nid}}")
+    assert byteLength(filename) <= generation.MAX_FILENAME_BYTES
+    field_part = filename[:-len("_1700000000123.mp3")]
+    half = len(field_part) // 2
+    # Both copies are the same and neither one got cut down to nothing
+    assert field_part[:half] == field_part[half:]
+    assert half > 0
+    # Not shortened more than needed, another character per copy wouldn't fit
+    assert byteLength(filename) + 2 * 3 > generation.MAX_FILENAME_BYTES
+
+def test_has_unique_placeholder_near_the_limit():
+    room = generation.MAX_FILENAME_BYTES - len(".opus") - generation.UNIQUE_PLACEHOLDER_BYTES["uid"]
+    assert generation.hasUniquePlaceholder("x" * room + "{{uid}}")
+    assert not generation.hasUniquePlaceholder("x" * (room + 1) + "{{uid}}")
+    # The text placeholders don't count, those get shortened
+    assert generation.hasUniquePlaceholder("x" * room + "{{uid}}{{text}}{{field:Front}}")
+    assert not generation.hasUniquePlaceholder("{{speaker}}_{{text}}")
+
+def test_uid_fits_at_the_limit():
+    room = generation.MAX_FILENAME_BYTES - len(".opus") - generation.UNIQUE_PLACEHOLDER_BYTES["uid"]
+    filename = getFilename("x" * room + "{{text}}{{uid}}", extension="opus")
+    assert re.fullmatch("x" * room + UID_RE + r"\.opus", filename)
@@ -0,0 +1,38 @@
+import sys
+from os.path import abspath, dirname
+
+# job_stats only uses the standard library, so it can be imported without Anki
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from job_stats import JobStats, percentile
+
+def test_percentile_nearest_rank():
+    assert percentile([1, 2], 50) == 1
+    assert percentile([3, 1, 2], 50) == 2
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 90) == 90
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile(list(range(1, 101)), 7) == 7
+
+def test_percentile_edges():
+    assert percentile([], 50) is None
+    assert percentile([5], 0) == 5
+    assert percentile([5], 99) == 5
+    assert percentile([1, 2, 3], 0) == 1
+
+def test_histogram_buckets():
+    stats = JobStats()
+    for seconds in [0.0005, 0.001, 0.0011, 0.05, 10.0, 20.0]:
+        stats.addTime("synthesis", seconds)
+    summary = stats.getStageSummary()["synthesis"]
+    histogram = summary['histogram']
+    # Bucket bounds are inclusive
+    assert histogram["<=1ms"] == 2
+    assert histogram["<=5ms"] == 1
+    assert histogram["<=50ms"] == 1
+    assert histogram["<=10000ms"] == 1
+    assert histogram[">10000ms"] == 1
+    assert sum(histogram.values()) == summary['count'] == 6
+    assert summary['max'] == 20.0
+    assert summary['p50'] == 0.0011
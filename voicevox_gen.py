@@ -2,22 +2,10 @@ from aqt.qt import QComboBox, QHBoxLayout, QLabel, QPushButton, QApplication, QM
 from aqt import browser, gui_hooks, qt
 from aqt import mw
 from aqt.sound import av_player
-import requests
-import json 
-import urllib.parse
-from aqt.utils import showText
-from os.path import join, exists, dirname
+from os.path import join, dirname
 import random
-import base64
-import uuid
-import re
-import zipfile
-import io
-from . import ffmpeg
-import traceback
-import re, html
-import json
-import datetime
+from . import generation
+from . import accent_cache
 
 VOICEVOX_CONFIG_NAME = "VOICEVOX_CONFIG"
 
@@ -38,34 +26,6 @@ def getCommonFields(selected_notes):
             common_fields = common_fields.intersection(model_fields) # Find the common fields by intersecting the set of all fields together
         first = False
     return common_fields
-def getSpeakersOrNone():
-    try:
-        speakers_response = requests.get("http://127.0.0.1:50021/speakers", timeout=5)
-        if speakers_response.status_code == 200:
-            print(speakers_response.content)
-            return json.loads(speakers_response.content)
-    except:
-        return None
-    
-def getSpeakerInfo(speaker_uuid):
-    try:
-        speakers_response = requests.get("http://127.0.0.1:50021/speaker_info?speaker_uuid=" + str(speaker_uuid), timeout=5)
-        if speakers_response.status_code == 200:
-            print(speakers_response.content)
-            return json.loads(speakers_response.content)
-    except:
-        return None
-    
-def getSpeakerList(speaker_json):
-    speakers = []
-    for obj in speaker_json:
-        styles = []
-        for style in obj['styles']:
-            styles.append( (style['name'], style['id']) )
-        #speaker_info = getSpeakerInfo(obj['speaker_uuid'])
-        speakers.append( (obj['name'], styles, obj['speaker_uuid']) )
-    return speakers
-
 def getSpeaker(speakers, speaker_combo, style_combo):
     speaker_name = speaker_combo.itemText(speaker_combo.currentIndex())
     speaker = next((x for x in speakers if x[0] == speaker_name), None)
@@ -82,33 +42,6 @@ def getSpeaker(speakers, speaker_combo, style_combo):
     speaker_id = style_info[1]
     return (speaker_id, speaker, style_info)
 
-def parse_filename_template(template: str, placeholders: dict) -> str:
-    """
-    Replaces placeholders of form {{...}} in the template with corresponding values.
-    Example placeholders:
-      {{uid}}, {{speaker}}, {{style}}, {{deck}}, {{deck-full}}, {{date}}, {{field:Foo}}
-    """
-    # For safety, let's keep a local copy
-    result = template
-
-    # Find all occurrences of {{xyz}}
-    all_placeholders = re.findall(r"{{(.*?)}}", template)
-    for ph in all_placeholders:
-        # For field placeholders: "field:myFieldName"
-        if ph.startswith("field:"):
-            field_name = ph[len("field:"):]
-            if field_name in placeholders.get("fields", {}):
-                val = placeholders["fields"][field_name]
-            else:
-                val = ""  # If field not found, replace with empty
-            result = result.replace(f"{{{{field:{field_name}}}}}", val)
-        else:
-            # Normal placeholders
-            val = placeholders.get(ph, "")
-            result = result.replace(f"{{{{{ph}}}}}", val)
-
-    return result
-
 class MyDialog(qt.QDialog):
     def __init__(self, browser, parent=None) -> None:
         super().__init__(parent)
@@ -179,14 +112,14 @@ class MyDialog(qt.QDialog):
         self.ignore_brackets_checkbox.setChecked(True)
         # self.grid_layout.addWidget(self.ignore_brackets_checkbox, 0, 4)
 
-        speaker_json = getSpeakersOrNone()
+        speaker_json = generation.getSpeakersOrNone(generation.getEngineUrl(config))
         if speaker_json is None:
             layout.addWidget(qt.QLabel("VOICEVOX service was unable to get speakers list. Please make sure the VOICEVOX service is running and reopen this dialog"))
             self.setLayout(layout)
             return
 
         self.grid_layout.addWidget(qt.QLabel("Speaker: "), 1, 0)
-        self.speakers = getSpeakerList(speaker_json)
+        self.speakers = generation.getSpeakerList(speaker_json)
         self.speaker_combo = qt.QComboBox()
         for speaker in self.speakers:
             self.speaker_combo.addItem(speaker[0])
@@ -272,16 +205,27 @@ class MyDialog(qt.QDialog):
         self.use_opus.setChecked(True if use_opus_checked == "true" else False)
         self.grid_layout.addWidget(self.use_opus, 2, 1)
 
+        self.use_speaker_mapping = qt.QCheckBox("Use speaker mapping")
+        if config.get('speaker_mapping'):
+            use_speaker_mapping_checked = config.get('use_speaker_mapping') or "false"
+            self.use_speaker_mapping.setChecked(True if use_speaker_mapping_checked == "true" else False)
+            self.use_speaker_mapping.setToolTip("Pick the speaker for each note from `speaker_mapping` in the addon config. Notes that don't match any rule use the speaker and style selected above")
+        else:
+            self.use_speaker_mapping.setEnabled(False)
+            self.use_speaker_mapping.setToolTip("Add rules to `speaker_mapping` in the addon config to pick a speaker per deck, note type or field")
+        self.grid_layout.addWidget(self.use_speaker_mapping, 2, 2, 1, 2)
+
         # Filename template
         self.grid_layout.addWidget(qt.QLabel("Filename: "), 3, 0)
         
         self.filename_template_edit = QLineEdit()
-        default_template = config.get('filename_template') or "VOICEVOX_{{speaker}}_{{style}}_{{uid}}"
+        default_template = config.get('filename_template') or generation.DEFAULT_FILENAME_TEMPLATE
         self.filename_template_edit.setText(default_template)
+        template_tooltip = "Use placeholders like " + ", ".join("{{" + placeholder + "}}" for placeholder in generation.FILENAME_PLACEHOLDERS) + "."
         self.filename_template_edit.setToolTip(
-            "Use placeholders like {{uid}}, {{speaker}}, {{style}}, {{deck}}, {{deck-full}}, {{date}}, or {{field:<fieldName>}}.\n"
+            template_tooltip + "\n"
             "Example: VOICEVOX_{{speaker}}_{{style}}_{{field:Card ID}}.mp3\n"
-            "If you omit {{uid}}, files may clash unless other placeholders ensure uniqueness."
+            "If you omit {{uid}}, {{hash}} and {{nid}}, files may clash unless other placeholders ensure uniqueness."
         )
         
         self.grid_layout.addWidget(self.filename_template_edit, 3, 1, 1, 3)
@@ -291,20 +235,15 @@ class MyDialog(qt.QDialog):
         self.help_button.setText("?")
         self.help_button.setToolTip(
             "Possible placeholders:\n"
-            "  {{uid}} - random unique identifier\n"
-            "  {{speaker}} - speaker name\n"
-            "  {{style}} - speaking style\n"
-            "  {{deck}} - card deck name\n"
-            "  {{deck-full}} - full card deck name, including parent deck hierarchy\n"
-            "  {{date}} - current date in ISO format\n"
-            "  {{field:<fieldName>}} - replaces with note field content\n\n"
-            "Example: VOICEVOX_{{speaker}}_{{style}}_{{field:ID}}_{{uid}}"
+            + "".join(f"  {{{{{placeholder}}}}} - {description}\n" for placeholder, description in generation.FILENAME_PLACEHOLDERS.items()) +
+            "\nExample: VOICEVOX_{{speaker}}_{{style}}_{{field:ID}}_{{uid}}\n"
+            "Use {{hash}} instead of {{uid}} to reuse the file when the same audio is generated again"
         )
         self.grid_layout.addWidget(self.help_button, 3, 4)
 
-        # Warning icon if {{uid}} is missing
+        # Warning icon if {{uid}} (or another placeholder that makes names unique) is missing
         self.uid_warning_label = QLabel()
-        self.uid_warning_label.setToolTip("Warning: Without {{uid}}, you might get file name collisions. Each generated audio must have a globally unique name.")
+        self.uid_warning_label.setToolTip("Warning: Without {{uid}}, {{hash}} or {{nid}} (or with so much other text around them that they don't fit in a file name), you might get file name collisions. Each generated audio must have a globally unique name.")
         # Use some built-in icon or text: exclamation triangle
         self.uid_warning_label.setPixmap(self.style().standardIcon(qt.QStyle.StandardPixmap.SP_MessageBoxWarning).pixmap(16,16))
         self.uid_warning_label.setVisible(False)
@@ -313,36 +252,19 @@ class MyDialog(qt.QDialog):
         # Red border if invalid placeholders
         def validate_template():
             t = self.filename_template_edit.text()
-            # If we find placeholders not recognized: we won't parse them now with a big logic,
-            # but let's warn if we see something that doesn't match recognized patterns.
-            # For simplicity, only check for missing 'uid' for now, or obviously invalid placeholders.
-            has_uid = "{{uid}}" in t
-            self.uid_warning_label.setVisible(not has_uid)
-
-            # Check for well-formed placeholders (all must be either "uid", "speaker", "style", "deck", "date", or "field:")
-            # We'll just do a quick check: anything that doesn't start with field: or match known placeholders is suspect.
-            # This is a mild approach; you can expand if needed.
-            found_placeholders = re.findall(r"{{(.*?)}}", t)
-            invalids = []
-            for ph in found_placeholders:
-                if ph not in ["uid", "speaker", "style", "deck", "deck-full", "date"] and not ph.startswith("field:"):
-                    invalids.append(ph)
-                elif ph.startswith("field:"):
-                    field_name = ph[len("field:"):].strip()
-                    if field_name not in common_fields:
-                        invalids.append(ph)
-            
+            self.uid_warning_label.setVisible(not generation.hasUniquePlaceholder(t))
+
+            # Same check generation uses, so anything flagged here would end up empty in the file name
+            invalids = generation.getInvalidPlaceholders(t, common_fields)
             if invalids:
                 self.filename_template_edit.setStyleSheet("border: 1px solid red;")
                 self.filename_template_edit.setToolTip(
                     f"Invalid placeholder(s) detected: {', '.join(invalids)}\n"
-                    "Valid placeholders: uid, speaker, style, deck, deck-full, date, field:<fieldName>"
+                    "Valid placeholders: " + ", ".join(generation.FILENAME_PLACEHOLDERS)
                 )
             else:
                 self.filename_template_edit.setStyleSheet("")
-                self.filename_template_edit.setToolTip(
-                    "Use placeholders like {{uid}}, {{speaker}}, {{style}}, {{deck}}, {{deck-full}}, {{date}}, or {{field:<fieldName>}}."
-                )
+                self.filename_template_edit.setToolTip(template_tooltip)
 
         self.filename_template_edit.textChanged.connect(validate_template)
         validate_template()
@@ -459,20 +381,8 @@ class MyDialog(qt.QDialog):
         (speaker_index, speaker, style_info) = getSpeaker(self.speakers, self.speaker_combo, self.style_combo)
         source_field = self.source_combo.itemText(self.source_combo.currentIndex())
         note = mw.col.get_note(note_id)
-        note_text = note[source_field]
-
-        # Remove html tags https://stackoverflow.com/a/19730306
-        tag_re = re.compile(r'(<!--.*?-->|<[^>]*>)')
-        entity_re = re.compile(r'(&[^;]+;)')
-
-        note_text = entity_re.sub('', note_text)
-        note_text = tag_re.sub('', note_text)
+        note_text = generation.getNoteText(note, source_field, self.ignore_brackets_checkbox.isChecked())
 
-        # Remove stuff between brackets. Usually japanese cards have pitch accent and reading info in brackets like 「 タイトル[;a,h] を 聞[き,きく;h]いた わけ[;a] じゃ ない[;a] ！」
-        if self.ignore_brackets_checkbox.isChecked():
-            note_text = re.sub("\[.*?\]", "", note_text)
-        note_text = re.sub(" ", "", note_text) # there's a lot of spaces for whatever reason which throws off the voice gen so we remove all spaces (japanese doesn't care about them anyway)
-        
         return (note_text, speaker_index)
 
     def PreviewVoice(self, sample=True):
@@ -493,9 +403,10 @@ class MyDialog(qt.QDialog):
             text, speaker_index = self.getNoteTextAndSpeaker(note_id)
             self.preview_note_index += 1
 
+        config = mw.addonManager.getConfig(__name__)
         tup = (text, speaker_index)
-        result = GenerateAudioQuery(tup, mw.addonManager.getConfig(__name__))
-        contents = SynthesizeAudio(result, speaker_index)
+        result = generation.GenerateAudioQuery(tup, config, accent_cache.getDefaultStore())
+        contents = generation.SynthesizeAudio(result, speaker_index, generation.getEngineUrl(config))
 
         addon_path = dirname(__file__)
         preview_path = join(addon_path, "VOICEVOX_preview.wav")
@@ -509,67 +420,11 @@ class MyDialog(qt.QDialog):
     def PreviewVoiceActual(self):
         self.PreviewVoice(sample=False)
 
-def GenerateAudioQuery(text_and_speaker_index_tuple, config):
-    try:
-        text = text_and_speaker_index_tuple[0]
-        speaker_index = text_and_speaker_index_tuple[1]
-        audio_query_response = requests.post("http://127.0.0.1:50021/audio_query?speaker=" + str(speaker_index) + "&text=" + urllib.parse.quote(text, safe=''))
-        if audio_query_response.status_code != 200:
-            raise Exception(f"Unable to generate audio for the following text: `{text}`. Response code was {audio_query_response.status_code}\nResponse:{audio_query_response.text}")
-            
-        result = audio_query_response.text
-        j = json.loads(result)
-        if config.get('speed_slider_value'):
-            j['speedScale'] = config.get('speed_slider_value') / 100;
-        if config.get('volume_slider_value'):
-            j['volumeScale'] = config.get('volume_slider_value') / 100;
-        if config.get('pitch_slider_value'):
-            j['pitchScale'] = config.get('pitch_slider_value') / 100;
-        if config.get('intonation_slider_value'):
-            j['intonationScale'] = config.get('intonation_slider_value') / 100;
-        if config.get('initial_silence_slider_value'):
-            j['prePhonemeLength'] = config.get('initial_silence_slider_value') / 100;
-        if config.get('final_silence_slider_value'):
-            j['postPhonemeLength'] = config.get('final_silence_slider_value') / 100;
-        result = json.dumps(j, ensure_ascii=False).encode('utf8')
-        return result
-    except Exception as e:
-        raise Exception(f"Unable to generate audio for the following text: `{text}`.\nResponse: {audio_query_response.text if audio_query_response is not None else 'None'}\n{traceback.format_exc()}")
-
-def SynthesizeAudio(audio_query_json, speaker_index):
-    synthesis_response = requests.post("http://127.0.0.1:50021/synthesis?speaker=" + str(speaker_index), data=audio_query_json)
-    if synthesis_response.status_code != 200:
-        return None
-    return synthesis_response.content
-
-def MultiSynthesizeAudio(audio_queries, speaker_index): # NOTE: This returns a zip
-    for q in audio_queries:
-        if q is None:
-            raise Exception("MultiSynthesizeAudio recieved an audio query that was None")
-    # Create json array of queries
-    combined = b"[" + b','.join(audio_queries) + b"]"
-
-    synthesis_response = requests.post("http://127.0.0.1:50021/multi_synthesis?speaker=" + str(speaker_index), data=combined)
-    if synthesis_response.status_code != 200:
-        return None
-    return synthesis_response.content 
-
-def DivideIntoChunks(array, n):
-    # looping till length l
-    for i in range(0, len(array), n):
-        yield array[i:i + n]
-
 def onVoicevoxOptionSelected(browser):
-    voicevox_exists = False
-    try:
-        response = requests.get("http://127.0.0.1:50021/version", timeout=5)
-        if response.status_code == 200:
-            print(f"version: {response.content}")
-            voicevox_exists = True
-    except:
-        print("Request timed out!")
-
-    if not voicevox_exists:
+    version = generation.getVersionOrNone(generation.getEngineUrl(mw.addonManager.getConfig(__name__)))
+    if version is not None:
+        print(f"version: {version}")
+    else:
         QMessageBox.critical(mw, "Error", f"VOICEVOX service is not running. Navigate to your VOICEVOX install and run 'run.exe'. You can download VOICEVOX from https://voicevox.hiroshiba.jp/ if you do not have it installed")
         return
 
@@ -594,13 +449,30 @@ def onVoicevoxOptionSelected(browser):
         config['last_style_name'] = style_combo_text
         config['append_audio'] = "true" if dialog.append_audio.isChecked() else "false"
         config['use_opus'] = "true" if dialog.use_opus.isChecked() else "false"
+        if dialog.use_speaker_mapping.isEnabled():
+            config['use_speaker_mapping'] = "true" if dialog.use_speaker_mapping.isChecked() else "false"
         config['filename_template'] = user_template
 
         mw.addonManager.writeConfig(__name__, config)
 
+        # We split the work into chunks so we can pass a bunch of audio queries to the synthesizer instead of doing them one at time, but we don't want to do all of them at once so chunks make the most sense
+        CHUNK_SIZE = 4
+        speaker_mapping = (config.get('speaker_mapping') or []) if dialog.use_speaker_mapping.isChecked() else []
+        selected_notes = [mw.col.get_note(note_id) for note_id in dialog.selected_notes]
+        try:
+            planned_chunks = generation.PlanSpeakerChunks(selected_notes, dialog.speakers, speaker_mapping, speaker_combo_text, style_combo_text, CHUNK_SIZE)
+        except Exception as e:
+            QMessageBox.critical(mw, "Error", f"{e}. Check `speaker_mapping` in the addon config")
+            return
+
+        try:
+            accent_cache.SyncUserDict(config.get('user_dict') or [], generation.getEngineUrl(config))
+        except Exception as e:
+            QMessageBox.warning(mw, "Warning", f"Unable to update the VOICEVOX user dictionary from `user_dict` in the addon config, generating without it.\n\n{e}")
+
         progress_window = qt.QWidget(None)
         progress_window.setWindowTitle("Generating VOICEVOX Audio")
-        progress_window.setFixedSize(400, 80)
+        progress_window.setFixedSize(400, 100)
 
         progress_text = qt.QLabel("Generating Audio...")
 
@@ -615,100 +487,23 @@ def onVoicevoxOptionSelected(browser):
         progress_window.show()
         progress_window.setFocus()
 
+        stats = generation.JobStats()
+
         def updateProgress(notes_so_far, total_notes, bottom_text = ''):
-            progress_text.setText(f"Generating Audio {notes_so_far}/{total_notes}\n{bottom_text}")
+            progress_text.setText(f"Generating Audio {notes_so_far}/{total_notes}\n{stats.getProgressText(notes_so_far, total_notes)}\n{bottom_text}")
             progress_bar.setMaximum(total_notes)
             progress_bar.setValue(notes_so_far)
             mw.app.processEvents()
-        def sanitize_filename(filename: str, replacement: str = "_") -> str:
-            # Replace problematic characters with a replacement character
-            sanitized = re.sub(r'[<>:"/\\|?*]', replacement, filename)
-            # Strip leading and trailing whitespaces and dots (Windows hates these)
-            sanitized = sanitized.strip().strip(".")
-            # Limit filename length to something reasonable (255 is typical for most filesystems)
-            return sanitized[:255]
 
-        # We split the work into chunks so we can pass a bunch of audio queries to the synthesizer instead of doing them one at time, but we don't want to do all of them at once so chunks make the most sense
-        CHUNK_SIZE = 4
-        note_chunks = DivideIntoChunks(dialog.selected_notes, CHUNK_SIZE)
-        notes_so_far = 0
-        total_notes = len(dialog.selected_notes)
-        updateProgress(notes_so_far, total_notes)
-
-        # Pre-cache user template for performance
-        filename_template = config.get("filename_template", "VOICEVOX_{{speaker}}_{{style}}_{{uid}}")
-
-        for note_chunk in note_chunks:
-            note_text_and_speakers = map(dialog.getNoteTextAndSpeaker, note_chunk)
-            updateProgress(notes_so_far, total_notes, f"Audio Query: {0}/{len(note_chunk)}")
-            query_count = 0
-            def GenerateQueryAndUpdateProgress(x, query_count):
-                updateProgress(notes_so_far, total_notes, f"Audio Query: {query_count}/{len(note_chunk)}")
-                query_count+=1
-                return GenerateAudioQuery(x, config)
-
-            audio_queries = list(map(lambda note: GenerateQueryAndUpdateProgress(note, query_count), note_text_and_speakers))
-            media_dir = mw.col.media.dir()
-            updateProgress(notes_so_far, total_notes, f"Synthesizing Audio {notes_so_far} to {min(notes_so_far+CHUNK_SIZE, total_notes)}")
-            zip_bytes = MultiSynthesizeAudio(audio_queries, speaker_index)
-
-            # MultiSynthesis returns zip bytes with ZIP_STORED
-            zip_counter = 0
-            with zipfile.ZipFile(io.BytesIO(zip_bytes), "r", zipfile.ZIP_STORED) as wavs_zip:
-                for name in wavs_zip.namelist():
-                    updateProgress(notes_so_far, total_notes, f"Converting Audio: {zip_counter}/{len(note_chunk)}")
-                    zip_counter+=1
-                    audio_data = wavs_zip.read(name)
-                    chunk_note_index = int(name.replace('.wav', '')) - 1 # Starts at 001.wav, this converts to 0 index
-                    note_id = note_chunk[chunk_note_index]
-                    
-                    audio_extension = "wav"
-
-                    new_audio_format = "opus" if config['use_opus'] == "true" else "mp3"
-                    new_audio_data = ffmpeg.ConvertWav(audio_data, new_audio_format)
-                    if new_audio_data != None:
-                        audio_data = new_audio_data
-                        audio_extension = new_audio_format
-
-                    # Build placeholders
-                    note_obj = mw.col.get_note(note_id)
-                    fields_map = {f: note_obj[f] for f in note_obj.keys()}
-                    cards_of_note = note_obj.cards()
-                    if cards_of_note:
-                        deck_id = cards_of_note[0].did
-                        deck_name = mw.col.decks.name(deck_id)
-                    else:
-                        deck_name = "UnknownDeck"
-
-                    placeholders = {
-                        "uid": str(uuid.uuid4()),
-                        "speaker": speaker_combo_text,
-                        "style": style_combo_text,
-                        "deck": deck_name.split("::")[-1],
-                        "deck-full": deck_name,
-                        "date": datetime.datetime.now().date().isoformat(),
-                        "fields": fields_map
-                    }
-
-                    raw_filename = parse_filename_template(filename_template, placeholders)
-                    raw_filename = sanitize_filename(raw_filename)
-                    # We'll add the final extension here
-                    filename = f"{raw_filename}.{audio_extension}"
-
-                    audio_full_path = join(media_dir, filename)
-
-                    with open(audio_full_path, "wb") as f:
-                        f.write(audio_data)
-
-                    audio_field_text = f"[sound:{filename}]"
-                    note = mw.col.get_note(note_id)
-                    if config['append_audio'] == "true":
-                        note[destination_field] += audio_field_text
-                    else:
-                        note[destination_field] = audio_field_text
-                    mw.col.update_note(note)
-                    mw.app.processEvents()
-                    notes_so_far += 1
+        generation.GenerateAudioForChunks(mw.col, planned_chunks, source_field, destination_field, config, updateProgress, dialog.ignore_brackets_checkbox.isChecked(), stats=stats, accent_store=accent_cache.getDefaultStore())
+
+        # Keep a report of where the time went so slow machines can be compared
+        report_info = {'notes': len(dialog.selected_notes), 'chunk_size': CHUNK_SIZE, 'format': generation.getAudioFormat(config), 'speakers': len(set((chunk[1], chunk[2]) for chunk in planned_chunks))}
+        try:
+            report_path = stats.writeReport(join(dirname(__file__), "user_files", "reports"), report_info)
+            print(f"VOICEVOX job report written to {report_path}")
+        except Exception as e:
+            print(f"Unable to write VOICEVOX job report: {e}")
         mw.progress.finish()
         mw.reset() # reset mw so our changes are applied
     else: